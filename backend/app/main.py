@@ -1,18 +1,32 @@
 # app/main.py
 
 from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from app.rag_engine import answer_query, MESSAGE_CODES
+from app.rag_engine import answer_query, get_pages_content, is_small_talk, preload_all, MESSAGE_CODES, SMALL_TALK_MESSAGE
+import asyncio
+import hashlib
+import json
+import logging
 import re
+import threading
+from collections import OrderedDict
+from contextvars import ContextVar
+from functools import lru_cache
+from itertools import islice
+from pathlib import Path
+from typing import AsyncIterator, NamedTuple, Optional, Tuple, Union
 
 
-from ollama import Client
+from ollama import AsyncClient
 from huggingface_hub import InferenceClient
 import os
 
+logger = logging.getLogger(__name__)
+
 # =====================================================
 # FastAPI App
 # =====================================================
@@ -42,9 +56,6 @@ class ChatResponse(BaseModel):
 # Ollama Client
 # =====================================================
 
-ollama_client = Client(host=OLLAMA_HOST)
-
-hf_client = InferenceClient(model=HF_MODEL, token=HF_TOKEN) if HF_TOKEN else None
 MODEL_NAME = "llama3.2:latest"
 
 # --- Deployment configuration (Local vs Hugging Face Spaces) ---
@@ -61,9 +72,30 @@ HF_TEMPERATURE = float(os.getenv("HF_TEMPERATURE", "0.2"))
 # HF sets SPACE_ID automatically in Spaces runtime
 RUNNING_ON_SPACES = bool(os.getenv("SPACE_ID"))
 
-def run_llm(prompt: str) -> str:
+# Parse all PDFs and build the section/building-block caches at boot so the
+# first query for each message does not pay for it. Set to 0 for fast reloads.
+PRELOAD_ON_STARTUP = os.getenv("PRELOAD_ON_STARTUP", "1") != "0"
+
+# Async client: the event loop keeps serving other requests while a
+# generation is in flight. For Ollama to actually run several generations
+# at once, start it with OLLAMA_NUM_PARALLEL > 1 (and raise
+# OLLAMA_MAX_LOADED_MODELS if more than one model is in use).
+ollama_client = AsyncClient(host=OLLAMA_HOST)
+
+hf_client = InferenceClient(model=HF_MODEL, token=HF_TOKEN) if HF_TOKEN else None
+
+# Set when an LLM call fails while serving the current request, so the
+# degraded fallback answer is never stored in the response cache.
+_llm_failed: ContextVar[bool] = ContextVar("llm_failed", default=False)
+
+# Generations currently running, keyed by prompt hash. Concurrent requests
+# with an identical prompt (several tabs asking "constraints of pain.001")
+# await the same Ollama call instead of queueing duplicates.
+_inflight_llm: "dict[str, asyncio.Task]" = {}
+
+async def _generate(prompt: str) -> Optional[str]:
     try:
-        response = ollama_client.generate(
+        response = await ollama_client.generate(
             model=MODEL_NAME,
             prompt=prompt,
             stream=False
@@ -73,15 +105,73 @@ def run_llm(prompt: str) -> str:
         print(f"[LLM ERROR] {e}")
         return None
 
+async def run_llm(prompt: str) -> str:
+    key = hashlib.sha1(prompt.encode("utf-8")).hexdigest()
+    task = _inflight_llm.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_generate(prompt))
+        _inflight_llm[key] = task
+        task.add_done_callback(lambda _: _inflight_llm.pop(key, None))
+
+    # shield: one client disconnecting must not cancel the shared call
+    result = await asyncio.shield(task)
+    if result is None:
+        _llm_failed.set(True)
+    return result
+
+async def stream_llm(prompt: str) -> AsyncIterator[str]:
+    """Yield response text from Ollama as tokens arrive. Errors propagate to the caller."""
+    async for part in await ollama_client.generate(
+        model=MODEL_NAME,
+        prompt=prompt,
+        stream=True
+    ):
+        text = part.get("response", "")
+        if text:
+            yield text
+
+# =====================================================
+# Response Cache (exact match, LRU)
+# =====================================================
+# ISO 20022 traffic repeats a lot ("constraints of pain.001", "show C17 ...").
+# Answers only depend on the query text and the static PDFs, which are read
+# once per process, so a hit can skip retrieval and the LLM call entirely.
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+
+RESPONSE_CACHE: "OrderedDict[str, str]" = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+def _normalize_query(query: str) -> str:
+    # Only whitespace is normalized: term extraction is case-sensitive
+    # (CamelCase element names, C-numbers, XML tags).
+    return " ".join((query or "").split())
+
+def _get_cached_response(key: str):
+    with _response_cache_lock:
+        answer = RESPONSE_CACHE.get(key)
+        if answer is not None:
+            RESPONSE_CACHE.move_to_end(key)
+        return answer
+
+def _cache_response(key: str, answer: str) -> None:
+    if RESPONSE_CACHE_SIZE <= 0:
+        return
+    with _response_cache_lock:
+        RESPONSE_CACHE[key] = answer
+        RESPONSE_CACHE.move_to_end(key)
+        while len(RESPONSE_CACHE) > RESPONSE_CACHE_SIZE:
+            RESPONSE_CACHE.popitem(last=False)
+
 
 
 # =====================================================
 # Deterministic constraint formatting (NO LLM)
 # =====================================================
 
-_CONSTRAINT_BLOCK_RE = re.compile(
-    r'(?m)^\s*(?:•\s*)?(C\d+)\s*([^\n]*)\n(.*?)(?=^\s*(?:•\s*)?C\d+\s|\Z)',
-    re.DOTALL
+# Matches only the constraint header line ("C17 Name"); bodies are sliced
+# between consecutive headers, so no lazy DOTALL scan is needed.
+_CONSTRAINT_HEADER_RE = re.compile(
+    r'(?m)^\s*(?:•\s*)?(C\d+)(?=\s)\s*([^\n]*)\n'
 )
 
 
@@ -92,25 +182,37 @@ _CONSTRAINT_BLOCK_RE = re.compile(
 # We only apply this cleanup inside constraint blocks to avoid impacting
 # other sections like Structure tables.
 # -------------------------------------------------
-_STANDALONE_PAGE_NUM_RE = re.compile(r'(?m)^\s*\d{1,4}\s*$')
-
 def _strip_standalone_page_numbers(s: str) -> str:
     if not s:
         return ""
-    s = _STANDALONE_PAGE_NUM_RE.sub("", s)
-    # Collapse excessive blank lines created by the removal
-    s = re.sub(r"\n{3,}", "\n\n", s)
-    return s.strip()
+    # Single pass: drop numeric-only lines and collapse the blank runs
+    # they leave behind (at most one empty line in a row)
+    out = []
+    prev_blank = False
+    for line in s.split("\n"):
+        stripped = line.strip()
+        if not stripped or (len(stripped) <= 4 and stripped.isdecimal()):
+            if not prev_blank:
+                out.append("")
+            prev_blank = True
+            continue
+        prev_blank = False
+        out.append(line)
+    return "\n".join(out).strip()
 
 def _format_all_constraints_exact(text: str) -> str:
     """Return all constraints exactly as in PDF content (no hallucinations)."""
-    matches = _CONSTRAINT_BLOCK_RE.findall((text or "").strip())
+    text = (text or "").strip()
+    matches = list(_CONSTRAINT_HEADER_RE.finditer(text))
     if not matches:
-        return (text or "").strip()
+        return text
 
     out = []
-    for code, name, body in matches:
-        body = _strip_standalone_page_numbers(body)
+    n = len(matches)
+    for i, m in enumerate(matches):
+        code, name = m.group(1, 2)
+        body_end = matches[i + 1].start() if i + 1 < n else len(text)
+        body = _strip_standalone_page_numbers(text[m.end():body_end])
         if not body:
             continue
         name = name.strip()
@@ -124,16 +226,15 @@ def _extract_specific_constraint_exact(text: str, target: str) -> str:
     if not target:
         return ""
 
-    # Search for the specific block by code
-    pattern = re.compile(
-        rf'(?m)^\s*(?:•\s*)?({re.escape(target)})\s*([^\n]*)\n(.*?)(?=^\s*(?:•\s*)?C\d+\s|\Z)',
-        re.DOTALL
-    )
-    m = pattern.search((text or "").strip())
+    # Search for the specific block by code, then slice until the next header
+    text = (text or "").strip()
+    m = next((h for h in _CONSTRAINT_HEADER_RE.finditer(text) if h.group(1) == target), None)
     if not m:
         return f"Constraint {target} not found in the PDF."
 
-    code, name, body = m.group(1), m.group(2).strip(), _strip_standalone_page_numbers(m.group(3))
+    nxt = _CONSTRAINT_HEADER_RE.search(text, m.end())
+    body_end = nxt.start() if nxt else len(text)
+    code, name, body = m.group(1), m.group(2).strip(), _strip_standalone_page_numbers(text[m.end():body_end])
     title = f"**{code} {name}**" if name else f"**{code}**"
     return f"{title}\n{body}"
 
@@ -142,14 +243,29 @@ def _extract_specific_constraint_exact(text: str, target: str) -> str:
 # Deterministic building-block extraction (NO LLM)
 # =====================================================
 
-_BLOCK_HEADING_RE = re.compile(
-    r'(?mi)^\s*(\d+(?:\.\d+)*\s+)?(?P<name>[A-Za-z][A-Za-z0-9\s]+?)\s*<(?P<tag>[A-Za-z0-9]+)>\s*$'
-)
-
 _NEXT_BLOCK_RE = re.compile(
-    r'(?mi)^\s*\d+(?:\.\d+)*\s+[A-Za-z][A-Za-z0-9\s]+?\s*<[^>]+>\s*$'
+    r'(?mi)^\s*\d+(?:\.\d+)*\s+[A-Za-z][A-Za-z0-9\s]+?\s*<(?P<tag>[^>]+)>\s*$'
 )
 
+@lru_cache(maxsize=256)
+def _block_tag_patterns(xml_tag: str) -> Tuple[re.Pattern, re.Pattern, re.Pattern]:
+    """Numbered heading, un-numbered heading and bare "<Tag>" patterns for one tag, compiled once."""
+    esc = re.escape(xml_tag)
+    return (
+        re.compile(rf'(?mi)^\s*\d+(?:\.\d+)*\s+.*?<\s*{esc}\s*>\s*$'),
+        re.compile(rf'(?mi)^\s*[A-Z][A-Za-z]+\s*<\s*{esc}\s*>\s*$'),
+        re.compile(rf'<\s*{esc}\s*>', re.IGNORECASE),
+    )
+
+@lru_cache(maxsize=256)
+def _block_name_patterns(element_name: str) -> Tuple[re.Pattern, re.Pattern]:
+    """Full-line and line-start heading patterns for one element name, compiled once."""
+    esc = re.escape(element_name)
+    return (
+        re.compile(rf'(?mi)^\s*\d*(?:\.\d+)*\s*{esc}\s*<[^>]+>\s*$'),
+        re.compile(rf'(?mi)^\s*{esc}\s*<[^>]+>'),
+    )
+
 def _extract_building_block_snippet(blocks_text: str, *, xml_tag: str = "", element_name: str = "", max_chars: int = 8000) -> str:
     """
     Extract a single building-block chunk from the full BLOCKS section text.
@@ -165,37 +281,35 @@ def _extract_building_block_snippet(blocks_text: str, *, xml_tag: str = "", elem
     # Prefer XML tag match (most reliable)
     start_idx = -1
     if xml_tag:
+        tag_pat, tag_pat2, _ = _block_tag_patterns(xml_tag)
         # Pattern 1: Full heading with numbering: "3.4.1 GroupHeader <GrpHdr>"
-        tag_pat = re.compile(rf'(?mi)^\s*\d+(?:\.\d+)*\s+.*?<\s*{re.escape(xml_tag)}\s*>\s*$', re.MULTILINE)
         m = tag_pat.search(t)
         if m:
             start_idx = m.start()
         
         # Pattern 2: Without numbering: "GroupHeader <GrpHdr>"
         if start_idx < 0:
-            tag_pat2 = re.compile(rf'(?mi)^\s*[A-Z][A-Za-z]+\s*<\s*{re.escape(xml_tag)}\s*>\s*$', re.MULTILINE)
             m = tag_pat2.search(t)
             if m:
                 start_idx = m.start()
 
     # Fallback: element name match
     if start_idx < 0 and element_name:
+        name_pat, name_pat2 = _block_name_patterns(element_name)
         # Try exact element name with XML tag
-        name_pat = re.compile(rf'(?mi)^\s*\d*(?:\.\d+)*\s*{re.escape(element_name)}\s*<[^>]+>\s*$', re.MULTILINE)
         m = name_pat.search(t)
         if m:
             start_idx = m.start()
         
         # Try element name without requiring full structure
         if start_idx < 0:
-            name_pat2 = re.compile(rf'(?mi)^\s*{re.escape(element_name)}\s*<[^>]+>', re.MULTILINE)
             m = name_pat2.search(t)
             if m:
                 start_idx = m.start()
 
     # Final fallback: look for "<Tag>" anywhere (less strict)
     if start_idx < 0 and xml_tag:
-        m = re.search(rf'<\s*{re.escape(xml_tag)}\s*>', t, flags=re.IGNORECASE)
+        m = _block_tag_patterns(xml_tag)[2].search(t)
         if m:
             # Back up to try to include the heading line
             start_idx = max(0, m.start() - 200)
@@ -203,14 +317,24 @@ def _extract_building_block_snippet(blocks_text: str, *, xml_tag: str = "", elem
     if start_idx < 0:
         return ""
 
-    tail = t[start_idx:]
-
-    # Stop at next block heading
-    nxt = _NEXT_BLOCK_RE.search(tail[1:])
-    end_idx = start_idx + (1 + nxt.start()) if nxt else min(len(t), start_idx + max_chars)
+    # Stop at next block heading (scan in place, no tail copy)
+    nxt = _NEXT_BLOCK_RE.search(t, start_idx + 1)
+    end_idx = nxt.start() if nxt else min(len(t), start_idx + max_chars)
 
     return t[start_idx:end_idx].strip()
 
+_DEF_PATTERNS = (
+    re.compile(r'(?mi)^\s*Definition:\s*(.+?)(?=\n\s*Usage:|\n\s*Datatype:|\n\s*Presence:|\n\s*\d+(?:\.\d+)*\s+[A-Z].*?<|$)', re.DOTALL),
+    re.compile(r'(?mi)Definition:\s*(.+?)(?=\nUsage:|\nDatatype:|\nPresence:|\n\d+(?:\.\d+)*\s+[A-Z]|$)', re.DOTALL),
+)
+
+_USE_PATTERNS = (
+    re.compile(r'(?mi)^\s*Usage:\s*(.+?)(?=\n\s*Datatype:|\n\s*Presence:|\n\s*\d+(?:\.\d+)*\s+[A-Z].*?<|$)', re.DOTALL),
+    re.compile(r'(?mi)Usage:\s*(.+?)(?=\nDatatype:|\nPresence:|\n\d+(?:\.\d+)*\s+[A-Z]|$)', re.DOTALL),
+)
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
 def _parse_definition_usage(snippet: str) -> tuple[str, str]:
     """
     Parse Definition and Usage from a block snippet.
@@ -225,37 +349,90 @@ def _parse_definition_usage(snippet: str) -> tuple[str, str]:
     s = snippet.replace("\r\n", "\n").replace("\r", "\n")
 
     # Capture Definition with improved pattern
-    def_patterns = [
-        r'(?mi)^\s*Definition:\s*(.+?)(?=\n\s*Usage:|\n\s*Datatype:|\n\s*Presence:|\n\s*\d+(?:\.\d+)*\s+[A-Z].*?<|$)',
-        r'(?mi)Definition:\s*(.+?)(?=\nUsage:|\nDatatype:|\nPresence:|\n\d+(?:\.\d+)*\s+[A-Z]|$)',
-    ]
-    
     definition = ""
-    for pattern in def_patterns:
-        def_m = re.search(pattern, s, flags=re.DOTALL)
+    for pattern in _DEF_PATTERNS:
+        def_m = pattern.search(s)
         if def_m:
             definition = def_m.group(1).strip()
             break
 
     # Capture Usage with improved pattern
-    use_patterns = [
-        r'(?mi)^\s*Usage:\s*(.+?)(?=\n\s*Datatype:|\n\s*Presence:|\n\s*\d+(?:\.\d+)*\s+[A-Z].*?<|$)',
-        r'(?mi)Usage:\s*(.+?)(?=\nDatatype:|\nPresence:|\n\d+(?:\.\d+)*\s+[A-Z]|$)',
-    ]
-    
     usage = ""
-    for pattern in use_patterns:
-        use_m = re.search(pattern, s, flags=re.DOTALL)
+    for pattern in _USE_PATTERNS:
+        use_m = pattern.search(s)
         if use_m:
             usage = use_m.group(1).strip()
             break
 
     # Clean bullet artifacts and normalize whitespace
-    definition = re.sub(r'\s+', ' ', definition).strip()
-    usage = re.sub(r'\s+', ' ', usage).strip()
+    definition = _WHITESPACE_RE.sub(' ', definition).strip()
+    usage = _WHITESPACE_RE.sub(' ', usage).strip()
 
     return definition, usage
 
+# PDF approval / maintenance boilerplate, removed once from the source text
+_BOILERPLATE_RE = re.compile(
+    r'(?:Approved by the Payments SEG|Exceptions and Investigations\s*-\s*Maintenance).*?(?:\n|$)',
+    re.IGNORECASE
+)
+
+def _format_building_block(title: str, definition_text: str, usage_text: str, page_ref: str, download_link: str) -> str:
+    """Deterministic Definition / Usage answer for one building block."""
+    out_lines = [f"**{title}**", ""]
+
+    if definition_text:
+        out_lines.append(f"• **Definition:** {definition_text}")
+        out_lines.append("")
+    if usage_text:
+        out_lines.append(f"• **Usage:** {usage_text}")
+        out_lines.append("")
+
+    footer = f"---\n\n{page_ref}\n\n{download_link}"
+    return "\n".join(out_lines).strip() + "\n\n" + footer
+
+# =====================================================
+# Building-block index: {(message_code, tag_lower) -> parsed block}
+# Each message's BLOCKS section is parsed once, on first use, so
+# specific_building_block answers become a dict lookup.
+# =====================================================
+
+BLOCKS_INDEX: dict[tuple[str, str], dict[str, str]] = {}
+_blocks_indexed: set[str] = set()
+_blocks_index_lock = threading.Lock()
+
+def _index_building_blocks(message_code: str) -> None:
+    if message_code in _blocks_indexed:
+        return
+    with _blocks_index_lock:
+        if message_code in _blocks_indexed:
+            return
+
+        t = get_pages_content(message_code, "blocks")
+        headings = list(_NEXT_BLOCK_RE.finditer(t))
+        for i, m in enumerate(headings):
+            end_idx = headings[i + 1].start() if i + 1 < len(headings) else min(len(t), m.start() + 8000)
+            snippet = _BOILERPLATE_RE.sub("", t[m.start():end_idx].strip())
+            definition_text, usage_text = _parse_definition_usage(snippet)
+            if not (definition_text or usage_text):
+                continue
+
+            head_m = _SNIPPET_TITLE_RE.search(snippet)
+            tag = m.group("tag").strip()
+            # First occurrence wins, like a top-down search of the section
+            BLOCKS_INDEX.setdefault((message_code, tag.lower()), {
+                "title": head_m.group(1).strip() if head_m else f"<{tag}>",
+                "definition": definition_text,
+                "usage": usage_text,
+            })
+
+        _blocks_indexed.add(message_code)
+
+def _lookup_building_block(message_code: str, xml_tag: str) -> Optional[dict[str, str]]:
+    _index_building_blocks(message_code)
+    return BLOCKS_INDEX.get((message_code, xml_tag.lower()))
+
+_TAG_ROW_RE = re.compile(r'([A-Za-z][A-Za-z0-9]+)\s*<\s*([A-Za-z0-9]+)\s*>')
+
 def _extract_messageelement_tags(snippet: str) -> list[str]:
     """
     Extract XML tags listed in MessageElement<XML Tag> rows within the snippet.
@@ -264,51 +441,43 @@ def _extract_messageelement_tags(snippet: str) -> list[str]:
     if not snippet:
         return []
 
-    tags = []
-    seen = set()
-
     # Match rows like: MessageIdentification <MsgId>
-    for m in re.finditer(r'([A-Za-z][A-Za-z0-9]+)\s*<\s*([A-Za-z0-9]+)\s*>', snippet):
-        tag = m.group(2)
-        if tag not in seen:
-            seen.add(tag)
-            tags.append(tag)
-    return tags
+    return list(dict.fromkeys(m.group(2) for m in _TAG_ROW_RE.finditer(snippet)))
+
+_XML_TAG_QUERY_RE = re.compile(r"<\s*([A-Za-z0-9]+)\s*>")
 
 def _extract_xml_tag_from_query(query: str) -> str:
     """Extract XML tag from user query (e.g., <MsgId> from the query)"""
-    xml_m = re.search(r"<\s*([A-Za-z0-9]+)\s*>", query)
+    xml_m = _XML_TAG_QUERY_RE.search(query)
     if xml_m:
         return xml_m.group(1)
     return ""
 
-def _extract_element_name_from_query(query: str, message_code: str) -> str:
+_CAMEL_CASE_RE = re.compile(r'\b([A-Z][a-z]+(?:[A-Z][a-z]*)+)\b')
+
+# Message codes plus the connecting words "in"/"for", removed from a field question in one pass
+_MSG_CODES_RE = re.compile("|".join(re.escape(c) for c in sorted(MESSAGE_CODES)) + r"|\b(?:in|for)\b")
+
+# Question words, section words, message codes (pain.001 / pain 001 / ...) and
+# XML tags, stripped in one pass
+_Q_STRIP_RE = re.compile(
+    r"(?i)\b(?:what is|show|explain|describe|tell me about|give me|find|message building blocks?|in|for|of)\b"
+    r"|\b(?:pain|pacs|camt)[\s.\-]?\d{3}\b"
+    r"|<[^>]+>"
+)
+
+def _extract_element_name_from_query(query: str) -> str:
     """
     Extract element name from query by removing common question words and message code.
     Returns clean element name (e.g., "GroupHeader", "MessageIdentification")
     """
-    # Remove common question patterns
-    cleaned = query
-    question_patterns = [
-        r"(?i)\b(what is|show|explain|describe|tell me about|give me|find)\b",
-        r"(?i)\bmessage building blocks?\b",
-        r"(?i)\bin\b",
-        r"(?i)\bfor\b",
-        r"(?i)\bof\b",
-        message_code,
-    ]
-    
-    for pattern in question_patterns:
-        cleaned = re.sub(pattern, "", cleaned)
-    
-    # Remove XML tags to get element name
-    cleaned = re.sub(r"<[^>]+>", "", cleaned)
+    cleaned = _Q_STRIP_RE.sub("", query)
     
     # Clean up and get CamelCase words or significant terms
     cleaned = cleaned.strip()
     
     # Try to find CamelCase word (most reliable)
-    camel_match = re.search(r'\b([A-Z][a-z]+(?:[A-Z][a-z]*)+)\b', cleaned)
+    camel_match = _CAMEL_CASE_RE.search(cleaned)
     if camel_match:
         return camel_match.group(1)
     
@@ -319,8 +488,305 @@ def _extract_element_name_from_query(query: str, message_code: str) -> str:
     
     return ""
 
-def enhance_with_llm(raw_content: str, user_query: str) -> str:
+# =====================================================
+# Response post-processing patterns (compiled once)
+# =====================================================
+
+_CONSTRAINT_CODE_RE = re.compile(r"C\d+")
+
+# Functionality presentation (spacing + bold headings)
+_SECTION_SPACING_RE = re.compile(r'\n(Scope|Usage|Outline)\n')
+_LETTER_DOT_RE = re.compile(r'\n([A-E]\.\s)')
+_BOLD_HEADINGS_RE = re.compile(r'(^|\n)(MessageDefinition Functionality|Scope|Usage|Outline)(\s*\n)', re.MULTILINE)
+_UNABLE_TO_APPLY_RE = re.compile(r'(^|\n)(The UnableToApply message:)(\s*\n)', re.MULTILINE)
+
+_SNIPPET_TITLE_RE = re.compile(r'(?mi)^\s*\d*(?:\.\d+)*\s*(.+?<[^>]+>)\s*$', re.MULTILINE)
+
+# =====================================================
+# Structured response parsing (output of answer_query)
+# =====================================================
+
+_HEADER_RE = re.compile(
+    r'(?m)^(MESSAGE_CODE|DEFINITION|PDF_FILE|QUERY_INTENT|WANTS_DETAILS|TARGET_PAGE|TARGET_TERM|SECTION_PAGES):(.*)$'
+)
+
+_HEADER_PARSERS = {
+    "MESSAGE_CODE": str,
+    "DEFINITION": str,
+    "PDF_FILE": str,
+    "QUERY_INTENT": str,
+    "WANTS_DETAILS": lambda v: v == "true",
+    "TARGET_PAGE": int,
+    "TARGET_TERM": str,
+}
+
+_CONTENT_START = "---CONTENT_START---"
+_CONTENT_END = "---CONTENT_END---"
+
+# The marker line plus the newlines around it, so split() yields clean bodies
+_SECTION_MARKER_RE = re.compile(r'(?m)(?:^|\n)##SECTION:([^\n]*)(?:\n|\Z)')
+
+def _split_structured_response(raw_content: str) -> tuple[str, str]:
+    """Split raw_content into (header_text, content_text) at the CONTENT markers."""
+    start = raw_content.find(f"\n{_CONTENT_START}\n")
+    if start < 0:
+        return raw_content, ""
+
+    content_start = start + len(_CONTENT_START) + 2
+    end = raw_content.find(f"\n{_CONTENT_END}", content_start - 1)
+    content_end = end if end >= 0 else len(raw_content)
+    return raw_content[:start], raw_content[content_start:content_end]
+
+def _parse_content_sections(content_text: str) -> dict[str, str]:
+    """
+    Split the content block on ##SECTION:NAME## markers.
+    Returns {NAME: body}; text before the first marker is ignored.
+    """
+    # re.split with one group yields [pre, name1, body1, name2, body2, ...]
+    parts = _SECTION_MARKER_RE.split(content_text)
+    sections = ((name.replace("##", "").strip(), body) for name, body in zip(parts[1::2], parts[2::2]))
+    return {name: body for name, body in sections if name and body}
+
+# =====================================================
+# Prompt budget (estimated tokens)
+# =====================================================
+# PDF text is punctuation-heavy ("<GrpHdr>", "[0..1]", "3.4.1"), so a fixed
+# character cut lands on a different token count every time. Budgets are
+# counted in estimated tokens instead: each punctuation mark and each run of
+# up to 5 word characters is one token. On the ISO PDFs that averages ~3.6
+# characters per token, close to llama3's tokenizer, without loading one.
+_TOKEN_RE = re.compile(r"\w{1,5}|[^\w\s]")
+
+LLM_CONTENT_TOKENS = int(os.getenv("LLM_CONTENT_TOKENS", "4096"))
+LLM_SNIPPET_TOKENS = int(os.getenv("LLM_SNIPPET_TOKENS", "1024"))
+LLM_PROMPT_TOKENS = int(os.getenv("LLM_PROMPT_TOKENS", "5632"))
+
+def _take_tokens(text: str, max_tokens: int) -> tuple[str, int]:
+    """Return (prefix of text with at most max_tokens tokens, tokens in that prefix)."""
+    if max_tokens <= 0:
+        return "", 0
+    count = 0
+    for m in _TOKEN_RE.finditer(text):
+        if count == max_tokens:
+            return text[:m.start()].rstrip(), count
+        count += 1
+    return text, count
+
+def _truncate_tokens(text: str, max_tokens: int) -> str:
+    return _take_tokens(text or "", max_tokens)[0]
+
+def _pack_sections(content_sections: dict[str, str], max_tokens: int, order: tuple[str, ...] = ()) -> str:
+    """
+    Join sections until the token budget runs out. Sections named in
+    `order` go first; the rest follow in their original order.
+    """
+    names = [n for n in order if n in content_sections]
+    names += [n for n in content_sections if n not in names]
+
+    parts = []
+    budget = max_tokens
+    for name in names:
+        if budget <= 0:
+            break
+        text, used = _take_tokens(content_sections[name], budget)
+        if text:
+            parts.append(text)
+        budget -= used
+    return "\n\n".join(parts)
+
+# =====================================================
+# LLM prompt templates
+# =====================================================
+# The instructions are static and come first; per-request values (message,
+# query, PDF content) come last. Requests of the same intent then share a
+# byte-identical prompt prefix that Ollama / llama.cpp can serve from the
+# prompt (KV) cache instead of re-running prefill over it.
+
+_BUILDING_BLOCK_PROMPT = """You are an ISO 20022 expert. Extract building block element information.
+
+CRITICAL INSTRUCTIONS:
+1. Find the element that matches USER ASKED ABOUT (given below)
+2. Look for a heading like "ElementName <Tag>", or just the tag "<Tag>" if USER ASKED ABOUT is an XML tag
+3. Extract ONLY what EXISTS in the PDF:
+   • **Definition:** (if present - extract the complete definition text)
+   • **Usage:** (ONLY if present - do NOT infer or reuse from other elements)
+
+4. Format your response EXACTLY like this:
+   ElementName <Tag>
+
+   • **Definition:** [exact definition text from PDF]
+
+   • **Usage:** [exact usage text from PDF - ONLY if it exists]
+
+5. DO NOT include:
+   - MessageElement XML tags list
+   - Explanations or interpretations
+   - Content from other elements
+   - Made-up information
+
+6. If the element is not found, respond ONLY with:
+   "Element '[USER ASKED ABOUT]' not found in [MESSAGE] message building blocks."
+
+---
+USER ASKED ABOUT: {search_term}
+MESSAGE: {message_code}
+ORIGINAL QUERY: {user_query}
+
+PDF CONTENT:
+{content}
+
+Provide the response:"""
+
+_CONSTRAINT_PROMPT = """You are an ISO 20022 expert. Extract constraint information from the PDF content.
+
+CRITICAL INSTRUCTIONS:
+1. Find the constraint named in CONSTRAINT (given below)
+2. Extract ONLY what's in the PDF:
+   - Constraint name/code
+   - Definition (exact wording)
+   - Usage rules (exact wording)
+   - Related MessageElement XML tags if mentioned
+3. Format clearly with the constraint name as heading
+4. DO NOT add explanations, interpretations, or additional text
+5. DO NOT say "unfortunately" or "I was unable to find" - just present what you found
+6. If the constraint is clearly defined, present it directly
+7. Keep exact wording from PDF
+
+---
+CONSTRAINT: {target_term}
+MESSAGE: {message_code}
+
+PDF CONTENT:
+{content}
+
+Provide the response (constraint info only):"""
+
+_ALL_CONSTRAINTS_PROMPT = """You are an ISO 20022 expert. List all constraints from the PDF.
+
+CRITICAL INSTRUCTIONS:
+1. List ALL constraints found (C1, C2, C3... up to C82 or however many exist)
+2. Format each as:
+   **C## ConstraintName**
+   [Exact definition from PDF]
+
+3. DO NOT skip constraints - include every single one
+4. DO NOT add guideline text or light font text
+5. Keep exact wording from PDF
+6. If a constraint has no description, skip it
+7. DO NOT truncate - list ALL constraints
+
+---
+MESSAGE: {message_code}
+
+PDF CONTENT:
+{content}
+
+Provide the complete list:"""
+
+_STRUCTURE_PROMPT = """You are an ISO 20022 expert. Present message structure.
+
+INSTRUCTIONS:
+1. Show structure with XML tags and cardinality
+2. Extract MessageElement column only from tables
+3. Keep hierarchy
+4. Format clearly
+5. DO NOT add explanations
+
+---
+MESSAGE: {message_code}
+
+PDF CONTENT:
+{content}
+
+Provide the response:"""
+
+_BLOCKS_PROMPT = """You are an ISO 20022 expert. Present building blocks.
+
+INSTRUCTIONS:
+1. List building blocks with names and cardinality
+2. Brief description for each
+3. Keep exact wording
+
+---
+MESSAGE: {message_code}
+
+PDF CONTENT:
+{content}
+
+Provide the response:"""
+
+_FIELD_PROMPT = """You are an ISO 20022 expert. Find specific field information.
+
+INSTRUCTIONS:
+1. Search for the field named in FIELD (given below)
+2. If found: XML tag, cardinality, definition
+3. Extract MessageElement only from tables
+4. If NOT found: "Could not find '[FIELD]' in [MESSAGE]."
+
+---
+FIELD: {field_name}
+MESSAGE: {message_code}
+
+PDF CONTENT:
+{content}
+
+Provide the response:"""
+
+_FUNCTIONALITY_PROMPT = """You are an ISO 20022 expert. Present the COMPLETE MessageDefinition - Functionality.
+
+INSTRUCTIONS:
+1. Present COMPLETE content - DO NOT summarize
+2. Include Scope, Usage, Outline from PDF
+3. Use bullet points where appropriate
+4. Keep exact wording
+
+---
+MESSAGE: {message_code}
+DEFINITION: {definition}
+
+PDF CONTENT:
+{content}
+
+Provide the complete response:"""
+
+# Words that only show up when the model drifts into SWIFT MT territory
+_HALLUCINATION_MARKERS = ("mt104", "mt103", "swift mt")
+
+def _build_response(*parts: str) -> str:
+    """Join the non-empty parts of a reply with blank lines."""
+    return "\n\n".join(p for p in parts if p)
+
+class _LLMPlan(NamedTuple):
+    """An answer that still needs the LLM: the prompt plus the text that frames or replaces its output."""
+    prompt: str
+    footer: str
+    fallback: str
+    hallucination_reply: Optional[str] = None
+
+def _finish_llm_answer(plan: _LLMPlan, result: Optional[str]) -> str:
+    if not result:
+        return plan.fallback
+
+    # Check for hallucination
+    if plan.hallucination_reply and any(word in result.lower() for word in _HALLUCINATION_MARKERS):
+        return plan.hallucination_reply
+
+    return result + plan.footer
+
+async def enhance_with_llm(raw_content: str, user_query: str) -> str:
     """Transform PDF content with page numbers and download links"""
+    # Regex-heavy formatting (and a first-use index build) stays off the event loop
+    plan = await run_in_threadpool(_plan_answer, raw_content, user_query)
+    if isinstance(plan, str):
+        return plan
+    return _finish_llm_answer(plan, await run_llm(plan.prompt))
+
+def _plan_answer(raw_content: str, user_query: str) -> Union[str, _LLMPlan]:
+    """
+    Build the final answer from answer_query output.
+    Deterministic intents return the finished text; intents that need the
+    LLM return an _LLMPlan so callers can run it blocking or streamed.
+    """
 
     # =====================================================
     # Handle small talk responses (no ISO formatting)
@@ -331,56 +797,29 @@ def enhance_with_llm(raw_content: str, user_query: str) -> str:
     if raw_content.startswith("ERROR:"):
         return raw_content.split("|")[1]
     
-    # Parse structured response
-    lines = raw_content.split("\n")
-    message_code = ""
-    definition = ""
-    intent = ""
-    pdf_file = ""
-    wants_details = True
-    target_page = None
-    target_term = ""
+    # Parse structured response: metadata header, then the content block
+    header_text, content_text = _split_structured_response(raw_content)
+
+    header = {}
     section_pages = {}
-    content_sections = {}
-    
-    current_section = None
-    section_content = []
-    in_content = False
-    
-    for line in lines:
-        if line.startswith("MESSAGE_CODE:"):
-            message_code = line.split(":", 1)[1]
-        elif line.startswith("DEFINITION:"):
-            definition = line.split(":", 1)[1]
-        elif line.startswith("PDF_FILE:"):
-            pdf_file = line.split(":", 1)[1]
-        elif line.startswith("QUERY_INTENT:"):
-            intent = line.split(":", 1)[1]
-        elif line.startswith("WANTS_DETAILS:"):
-            wants_details = line.split(":", 1)[1] == "true"
-        elif line.startswith("TARGET_PAGE:"):
-            target_page = int(line.split(":", 1)[1])
-        elif line.startswith("TARGET_TERM:"):
-            target_term = line.split(":", 1)[1]
-        elif line.startswith("SECTION_PAGES:"):
-            parts = line.split(":", 2)
-            if len(parts) == 3:
-                section_name = parts[1]
-                page_range = parts[2]
+    for m in _HEADER_RE.finditer(header_text):
+        key, value = m.group(1, 2)
+        if key == "SECTION_PAGES":
+            section_name, sep, page_range = value.partition(":")
+            if sep:
                 section_pages[section_name] = page_range
-        elif line == "---CONTENT_START---":
-            in_content = True
-        elif line == "---CONTENT_END---":
-            if current_section and section_content:
-                content_sections[current_section] = "\n".join(section_content)
-            break
-        elif in_content and line.startswith("##SECTION:"):
-            if current_section and section_content:
-                content_sections[current_section] = "\n".join(section_content)
-            current_section = line.replace("##SECTION:", "").replace("##", "").strip()
-            section_content = []
-        elif in_content and current_section:
-            section_content.append(line)
+        else:
+            header[key] = _HEADER_PARSERS[key](value)
+
+    message_code = header.get("MESSAGE_CODE", "")
+    definition = header.get("DEFINITION", "")
+    intent = header.get("QUERY_INTENT", "")
+    pdf_file = header.get("PDF_FILE", "")
+    wants_details = header.get("WANTS_DETAILS", True)
+    target_page = header.get("TARGET_PAGE")
+    target_term = header.get("TARGET_TERM", "")
+
+    content_sections = _parse_content_sections(content_text)
     
     # Build page reference
     page_ref = ""
@@ -392,14 +831,21 @@ def enhance_with_llm(raw_content: str, user_query: str) -> str:
     
     # Build download link
     download_link = f"📄 Download PDF: http://localhost:8000/pdfs/{pdf_file}"
+    footer = "\n\n---\n\n" + _build_response(page_ref, download_link)
     
     # Handle location-only
     if not wants_details:
-        return f"**{message_code}**\n\n{definition}\n\n{page_ref}\n\n{download_link}\n\n💡 *Open the link above to view the detailed content in the PDF.*"
+        return _build_response(
+            f"**{message_code}**", definition, page_ref, download_link,
+            "💡 *Open the link above to view the detailed content in the PDF.*",
+        )
     
     # No content extracted
     if not content_sections:
-        return f"**{message_code}**\n\n{definition}\n\n{page_ref}\n\n{download_link}\n\nNo detailed content extracted. Please refer to the PDF."
+        return _build_response(
+            f"**{message_code}**", definition, page_ref, download_link,
+            "No detailed content extracted. Please refer to the PDF.",
+        )
     
     
 
@@ -409,14 +855,13 @@ def enhance_with_llm(raw_content: str, user_query: str) -> str:
     # =====================================================
     if intent == "constraints":
         # Only treat C## as specific constraints
-        if target_term and re.fullmatch(r"C\d+", target_term):
+        if target_term and _CONSTRAINT_CODE_RE.fullmatch(target_term):
             src = content_sections.get("EXTRACTED", "") or content_sections.get("CONSTRAINTS", "")
             result = _extract_specific_constraint_exact(src, target_term)
         else:
             src = content_sections.get("CONSTRAINTS", "")
             result = _format_all_constraints_exact(src)
 
-        footer = f"\n\n---\n\n{page_ref}\n\n{download_link}"
         return result + footer
 # =====================================================
     # =====================================================
@@ -428,64 +873,32 @@ def enhance_with_llm(raw_content: str, user_query: str) -> str:
         func_content = content_sections.get("FUNCTIONALITY", "")
         
         if not func_content:
-            return f"**{message_code}**\n\n{definition}\n\n{page_ref}\n\n{download_link}\n\nNo functionality content found."
+            return _build_response(
+                f"**{message_code}**", definition, page_ref, download_link,
+                "No functionality content found.",
+            )
         
         # Deterministic formatting with bold headings
-        formatted_content = func_content
-
         # -------------------------------------------------
         # REMOVE PDF boilerplate (approval / maintenance)
         # -------------------------------------------------
-        formatted_content = re.sub(
-            r'Approved by the Payments SEG.*?(?:\n|$)',
-            '',
-            formatted_content,
-            flags=re.IGNORECASE
-        )
-        formatted_content = re.sub(
-            r'Exceptions and Investigations\s*-\s*Maintenance.*?(?:\n|$)',
-            '',
-            formatted_content,
-            flags=re.IGNORECASE
-        )
+        formatted_content = _BOILERPLATE_RE.sub('', func_content)
 
         # -------------------------------------------------
         # Improve spacing for readability (presentation only)
         # -------------------------------------------------
-        formatted_content = re.sub(
-            r'\n(Scope|Usage|Outline)\n',
-            r'\n\n\1\n',
-            formatted_content
-        )
-        formatted_content = re.sub(
-            r'\n([A-E]\.\s)',
-            r'\n\n\1',
-            formatted_content
-        )
+        formatted_content = _SECTION_SPACING_RE.sub(r'\n\n\1\n', formatted_content)
+        formatted_content = _LETTER_DOT_RE.sub(r'\n\n\1', formatted_content)
 
         # -------------------------------------------------
         # Make specific headings bold
         # -------------------------------------------------
-        formatted_content = re.sub(
-            r'(^|\n)(MessageDefinition Functionality|Scope|Usage|Outline)(\s*\n)',
-            r'\1**\2**\3',
-            formatted_content,
-            flags=re.MULTILINE
-        )
+        formatted_content = _BOLD_HEADINGS_RE.sub(r'\1**\2**\3', formatted_content)
 
         # Also bold "The UnableToApply message:" heading
-        formatted_content = re.sub(
-            r'(^|\n)(The UnableToApply message:)(\s*\n)',
-            r'\1**\2**\3',
-            formatted_content,
-            flags=re.MULTILINE
-        )
+        formatted_content = _UNABLE_TO_APPLY_RE.sub(r'\1**\2**\3', formatted_content)
 # Build response with message header
-        result = f"**{message_code}**\n\n{definition}\n\n{formatted_content}"
-        
-        # Add footer
-        footer = f"\n\n---\n\n{page_ref}\n\n{download_link}"
-        return result + footer
+        return _build_response(f"**{message_code}**", definition, formatted_content) + footer
     
     # =====================================================
     # CRITICAL FIX: Building Blocks - Improved Extraction
@@ -495,20 +908,29 @@ def enhance_with_llm(raw_content: str, user_query: str) -> str:
 
         # Extract XML tag and element name from query
         xml_tag = _extract_xml_tag_from_query(user_query)
-        element_name = _extract_element_name_from_query(user_query, message_code)
+        element_name = _extract_element_name_from_query(user_query)
 
-        print(f"[DEBUG] Building block search - XML Tag: '{xml_tag}', Element Name: '{element_name}'")
+        logger.debug("Building block search - XML Tag: '%s', Element Name: '%s'", xml_tag, element_name)
+
+        # Precomputed index: one dict lookup when the query names an XML tag
+        if xml_tag:
+            block = _lookup_building_block(message_code, xml_tag)
+            if block:
+                return _format_building_block(
+                    block["title"], block["definition"], block["usage"], page_ref, download_link
+                )
 
         # Try deterministic extraction
         snippet = _extract_building_block_snippet(blocks_content, xml_tag=xml_tag, element_name=element_name)
 
         if snippet:
-            print(f"[DEBUG] Found snippet (length: {len(snippet)})")
+            snippet = _BOILERPLATE_RE.sub("", snippet)
+            logger.debug("Found snippet (length: %d)", len(snippet))
             definition_text, usage_text = _parse_definition_usage(snippet)
 
             # Try to build a nice title from the snippet heading
             title = ""
-            head_m = re.search(r'(?mi)^\s*\d*(?:\.\d+)*\s*(.+?<[^>]+>)\s*$', snippet, re.MULTILINE)
+            head_m = _SNIPPET_TITLE_RE.search(snippet)
             if head_m:
                 title = head_m.group(1).strip()
             elif xml_tag and element_name:
@@ -522,91 +944,29 @@ def enhance_with_llm(raw_content: str, user_query: str) -> str:
 
             # If we found at least Definition or Usage, return deterministically
             if definition_text or usage_text:
-                out_lines = [f"**{title}**", ""]
-
-                # Remove PDF approval / maintenance boilerplate
-                definition_text = re.sub(
-                    r'Approved by the Payments SEG.*?(?:\n|$)',
-                    '',
-                    definition_text,
-                    flags=re.IGNORECASE
-                )
-                usage_text = re.sub(
-                    r'Approved by the Payments SEG.*?(?:\n|$)',
-                    '',
-                    usage_text,
-                    flags=re.IGNORECASE
-                )
-                definition_text = re.sub(
-                    r'Exceptions and Investigations\s*-\s*Maintenance.*?(?:\n|$)',
-                    '',
-                    definition_text,
-                    flags=re.IGNORECASE
-                )
-                usage_text = re.sub(
-                    r'Exceptions and Investigations\s*-\s*Maintenance.*?(?:\n|$)',
-                    '',
-                    usage_text,
-                    flags=re.IGNORECASE
-                )
-
-                if definition_text:
-                    out_lines.append(f"• **Definition:** {definition_text}")
-                    out_lines.append("")
-                if usage_text:
-                    out_lines.append(f"• **Usage:** {usage_text}")
-                    out_lines.append("")
-
-                footer = f"---\n\n{page_ref}\n\n{download_link}"
-                return "\n".join(out_lines).strip() + "\n\n" + footer
+                return _format_building_block(title, definition_text, usage_text, page_ref, download_link)
 
         # Deterministic extraction failed - fall back to LLM with improved prompt
-        print(f"[DEBUG] Deterministic extraction failed, falling back to LLM")
+        logger.debug("Deterministic extraction failed, falling back to LLM")
         
         # Build clear search term for LLM
         search_term = xml_tag if xml_tag else element_name if element_name else "the requested element"
         
-        prompt = f"""You are an ISO 20022 expert. Extract building block element information.
-
-USER ASKED ABOUT: {search_term} in {message_code}
-ORIGINAL QUERY: {user_query}
-
-PDF CONTENT:
-{(blocks_content or "")[:15000]}
-
-CRITICAL INSTRUCTIONS:
-1. Find the element that matches: {search_term}
-2. Look for a heading like "ElementName <Tag>" or just the tag "<{xml_tag}>" if provided
-3. Extract ONLY what EXISTS in the PDF:
-   • **Definition:** (if present - extract the complete definition text)
-   • **Usage:** (ONLY if present - do NOT infer or reuse from other elements)
-
-4. Format your response EXACTLY like this:
-   ElementName <Tag>
-
-   • **Definition:** [exact definition text from PDF]
-
-   • **Usage:** [exact usage text from PDF - ONLY if it exists]
-
-5. DO NOT include:
-   - MessageElement XML tags list
-   - Explanations or interpretations
-   - Content from other elements
-   - Made-up information
-
-6. If the element is not found, respond ONLY with:
-   "Element '{search_term}' not found in {message_code} message building blocks."
-
-Provide the response:"""
+        prompt = _BUILDING_BLOCK_PROMPT.format(
+            search_term=search_term,
+            message_code=message_code,
+            user_query=user_query,
+            content=_truncate_tokens(blocks_content, LLM_CONTENT_TOKENS),
+        )
 
-        result = run_llm(prompt)
-        
-        if not result:
-            return f"**{message_code}**\n\n{definition}\n\n{page_ref}\n\n{download_link}\n\nUnable to extract building block information."
-        
-        # Add footer
-        footer = f"\n\n---\n\n{page_ref}\n\n{download_link}"
-        return result + footer
+        return _LLMPlan(
+            prompt=prompt,
+            footer=footer,
+            fallback=_build_response(
+                f"**{message_code}**", definition, page_ref, download_link,
+                "Unable to extract building block information.",
+            ),
+        )
 
     # =====================================================
     # Handle other intents with existing logic
@@ -616,91 +976,40 @@ Provide the response:"""
     if intent == "constraints" and target_term:
         # Specific constraint
         extracted_content = content_sections.get("EXTRACTED", "")
-        if not extracted_content:
-            extracted_content = "\n\n".join(content_sections.values())
+        if extracted_content:
+            extracted_content = _truncate_tokens(extracted_content, LLM_SNIPPET_TOKENS)
+        else:
+            # Only as many sections as fit the snippet budget, constraints first
+            extracted_content = _pack_sections(content_sections, LLM_SNIPPET_TOKENS, order=("CONSTRAINTS",))
         
-        prompt = f"""You are an ISO 20022 expert. Extract constraint information from the PDF content.
-
-CONSTRAINT: {target_term} in {message_code}
-
-PDF CONTENT:
-{extracted_content[:4000]}
-
-CRITICAL INSTRUCTIONS:
-1. Find the constraint "{target_term}"
-2. Extract ONLY what's in the PDF:
-   - Constraint name/code
-   - Definition (exact wording)
-   - Usage rules (exact wording)
-   - Related MessageElement XML tags if mentioned
-3. Format clearly with the constraint name as heading
-4. DO NOT add explanations, interpretations, or additional text
-5. DO NOT say "unfortunately" or "I was unable to find" - just present what you found
-6. If the constraint is clearly defined, present it directly
-7. Keep exact wording from PDF
-
-Provide the response (constraint info only):"""
+        prompt = _CONSTRAINT_PROMPT.format(
+            target_term=target_term,
+            message_code=message_code,
+            content=extracted_content,
+        )
 
     elif intent == "constraints":
         # All constraints
         constraint_content = content_sections.get("CONSTRAINTS", "")
-        prompt = f"""You are an ISO 20022 expert. List all constraints from the PDF.
-
-MESSAGE: {message_code}
-
-PDF CONTENT:
-{constraint_content}
-
-CRITICAL INSTRUCTIONS:
-1. List ALL constraints found (C1, C2, C3... up to C82 or however many exist)
-2. Format each as:
-   **C## ConstraintName**
-   [Exact definition from PDF]
-
-3. DO NOT skip constraints - include every single one
-4. DO NOT add guideline text or light font text
-5. Keep exact wording from PDF
-6. If a constraint has no description, skip it
-7. DO NOT truncate - list ALL constraints
-
-Provide the complete list:"""
+        prompt = _ALL_CONSTRAINTS_PROMPT.format(message_code=message_code, content=constraint_content)
 
     elif intent == "structure":
         structure_content = content_sections.get("STRUCTURE", "")
-        prompt = f"""You are an ISO 20022 expert. Present message structure.
-
-MESSAGE: {message_code}
-
-PDF CONTENT:
-{structure_content[:15000]}
-
-INSTRUCTIONS:
-1. Show structure with XML tags and cardinality
-2. Extract MessageElement column only from tables
-3. Keep hierarchy
-4. Format clearly
-5. DO NOT add explanations
-
-Provide the response:"""
+        prompt = _STRUCTURE_PROMPT.format(
+            message_code=message_code,
+            content=_truncate_tokens(structure_content, LLM_CONTENT_TOKENS),
+        )
 
     elif intent == "blocks":
         blocks_content = content_sections.get("BLOCKS", "")
-        prompt = f"""You are an ISO 20022 expert. Present building blocks.
-
-MESSAGE: {message_code}
-
-PDF CONTENT:
-{blocks_content[:15000]}
-
-INSTRUCTIONS:
-1. List building blocks with names and cardinality
-2. Brief description for each
-3. Keep exact wording
-
-Provide the response:"""
+        prompt = _BLOCKS_PROMPT.format(
+            message_code=message_code,
+            content=_truncate_tokens(blocks_content, LLM_CONTENT_TOKENS),
+        )
 
     elif intent == "specific_field":
-        all_content = "\n\n".join(content_sections.values())
+        # A target extracted by answer_query is the most specific content
+        all_content = _pack_sections(content_sections, LLM_CONTENT_TOKENS, order=("EXTRACTED",))
         
         field_keywords = ["what is", "explain", "describe", "tell me about", "show"]
         field_name = user_query.lower()
@@ -709,65 +1018,38 @@ Provide the response:"""
                 field_name = field_name.split(kw)[1].strip()
                 break
         
-        for code in MESSAGE_CODES:
-            field_name = field_name.replace(code, "").replace("in", "").replace("for", "").strip()
+        field_name = _MSG_CODES_RE.sub("", field_name).strip()
         
-        prompt = f"""You are an ISO 20022 expert. Find specific field information.
-
-FIELD: {field_name} in {message_code}
-
-PDF CONTENT:
-{all_content[:15000]}
-
-INSTRUCTIONS:
-1. Search for "{field_name}"
-2. If found: XML tag, cardinality, definition
-3. Extract MessageElement only from tables
-4. If NOT found: "Could not find '{field_name}' in {message_code}."
-
-Provide the response:"""
+        prompt = _FIELD_PROMPT.format(field_name=field_name, message_code=message_code, content=all_content)
 
     else:
         # Fallback - should not reach here with new intent logic
         func_content = content_sections.get("FUNCTIONALITY", "")
-        prompt = f"""You are an ISO 20022 expert. Present the COMPLETE MessageDefinition - Functionality.
-
-MESSAGE: {message_code}
-DEFINITION: {definition}
-
-PDF CONTENT:
-{func_content}
-
-INSTRUCTIONS:
-1. Present COMPLETE content - DO NOT summarize
-2. Include Scope, Usage, Outline from PDF
-3. Use bullet points where appropriate
-4. Keep exact wording
-
-Provide the complete response:"""
+        prompt = _FUNCTIONALITY_PROMPT.format(
+            message_code=message_code,
+            definition=definition,
+            content=func_content,
+        )
 
-    # Call LLM
-    if len(prompt) > 20000:
-        prompt = prompt[:20000] + "\n\n[Truncated]"
-    
-    result = run_llm(prompt)
-    
-    if not result:
-        fallback = f"**{message_code}**\n\n{definition}\n\n"
-        if content_sections:
-            for section, content in list(content_sections.items())[:2]:
-                fallback += f"\n### {section}\n{content[:1000]}...\n"
-        fallback += f"\n{page_ref}\n\n{download_link}"
-        return fallback
+    # LLM prompt (the caller runs it, blocking or streamed)
+    truncated = _truncate_tokens(prompt, LLM_PROMPT_TOKENS)
+    if len(truncated) < len(prompt):
+        prompt = truncated + "\n\n[Truncated]"
     
-    # Check for hallucination
-    if any(word in result.lower() for word in ["mt104", "mt103", "swift mt"]):
-        result = f"**{message_code}**\n\n{definition}\n\nPlease refer to the PDF.\n\n{page_ref}\n\n{download_link}"
-        return result
-    
-    # Add footer
-    footer = f"\n\n---\n\n{page_ref}\n\n{download_link}"
-    return result + footer
+    fallback = f"**{message_code}**\n\n{definition}\n\n"
+    if content_sections:
+        for section, content in islice(content_sections.items(), 2):
+            fallback += f"\n### {section}\n{content[:1000]}...\n"
+    fallback += f"\n{page_ref}\n\n{download_link}"
+
+    return _LLMPlan(
+        prompt=prompt,
+        footer=footer,
+        fallback=fallback,
+        hallucination_reply=_build_response(
+            f"**{message_code}**", definition, "Please refer to the PDF.", page_ref, download_link
+        ),
+    )
 
 # =====================================================
 # Startup
@@ -779,18 +1061,31 @@ def startup_event():
     print("ISO 20022 Learning Chatbot API")
     print("=" * 60)
 
+    if PRELOAD_ON_STARTUP:
+        preload_all()
+        for code in sorted(MESSAGE_CODES):
+            _index_building_blocks(code)
+        print(f"[RAG] Indexed {len(BLOCKS_INDEX)} building blocks")
+
 # =====================================================
 # PDF Download Endpoint
 # =====================================================
 
+PDF_DIR = Path(__file__).resolve().parent.parent / "data"
+
+@lru_cache(maxsize=256)
+def _resolve_pdf(filename: str) -> Optional[Path]:
+    # The PDFs ship with the image, so one stat per filename is enough
+    pdf_path = PDF_DIR / filename
+    return pdf_path if pdf_path.is_file() else None
+
 @app.get("/pdfs/{filename}")
 def download_pdf(filename: str):
     """Serve PDF files"""
-    backend_root = os.path.dirname(os.path.dirname(__file__))
-    pdf_path = os.path.join(backend_root, "data", filename)
+    pdf_path = _resolve_pdf(filename)
     
-    if os.path.exists(pdf_path):
-        return FileResponse(pdf_path, media_type="application/pdf", filename=filename)
+    if pdf_path:
+        return FileResponse(str(pdf_path), media_type="application/pdf", filename=filename)
     else:
         return {"error": "PDF not found"}
 
@@ -799,17 +1094,71 @@ def download_pdf(filename: str):
 # =====================================================
 
 @app.post("/api/chat", response_model=ChatResponse)
-def chat_endpoint(request: ChatRequest):
-    raw_content = answer_query(request.query)
-    final_answer = enhance_with_llm(raw_content, request.query)
+async def chat_endpoint(request: ChatRequest):
+    # Greetings need no retrieval or formatting
+    if is_small_talk(request.query):
+        return ChatResponse(answer=SMALL_TALK_MESSAGE)
+
+    cache_key = _normalize_query(request.query)
+    cached = _get_cached_response(cache_key)
+    if cached is not None:
+        return ChatResponse(answer=cached)
+
+    _llm_failed.set(False)
+    # Answer from the cache key itself so cold and cached answers always agree.
+    # PDF retrieval is blocking; keep it off the event loop
+    raw_content = await run_in_threadpool(answer_query, cache_key)
+    final_answer = await enhance_with_llm(raw_content, cache_key)
+    if not _llm_failed.get():
+        _cache_response(cache_key, final_answer)
     return ChatResponse(answer=final_answer)
 
 
+# =====================================================
+# Streaming Chat Endpoint (Server-Sent Events)
+# =====================================================
+
+def _sse(text: str) -> str:
+    return f"data: {json.dumps({'response': text})}\n\n"
+
+async def _stream_answer(query: str) -> AsyncIterator[str]:
+    cache_key = _normalize_query(query)
+    cached = _get_cached_response(cache_key)
+    if cached is not None:
+        yield _sse(cached)
+    elif is_small_talk(query):
+        yield _sse(SMALL_TALK_MESSAGE)
+    else:
+        raw_content = await run_in_threadpool(answer_query, cache_key)
+        plan = await run_in_threadpool(_plan_answer, raw_content, cache_key)
+
+        if isinstance(plan, str):
+            # Deterministic answers (constraints, functionality, blocks) are complete already
+            _cache_response(cache_key, plan)
+            yield _sse(plan)
+        else:
+            # Streamed text cannot be retracted, so the hallucination check
+            # of /api/chat does not apply here and the answer is not cached.
+            streamed_any = False
+            try:
+                async for text in stream_llm(plan.prompt):
+                    streamed_any = True
+                    yield _sse(text)
+            except Exception:
+                logger.warning("LLM stream failed", exc_info=True)
+
+            yield _sse(plan.footer if streamed_any else plan.fallback)
+
+    yield f"data: {json.dumps({'done': True})}\n\n"
+
+@app.post("/api/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    return StreamingResponse(_stream_answer(request.query), media_type="text/event-stream")
+
 
 # --- Serve built frontend (for Hugging Face Spaces / single-link deployments) ---
 # If you build the React app into /frontend/dist, FastAPI will serve it as a static website.
 try:
-    from pathlib import Path
     FRONTEND_DIST = (Path(__file__).resolve().parents[2] / "frontend" / "dist")
     if FRONTEND_DIST.exists():
         app.mount("/", StaticFiles(directory=str(FRONTEND_DIST), html=True), name="frontend")
@@ -1,9 +1,19 @@
 # app/rag_engine.py
+import logging
 import os
 import re
-from typing import List, Tuple, Optional, Dict
+import multiprocessing
+import threading
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import groupby, islice, repeat
+from types import MappingProxyType
+from typing import List, Mapping, NamedTuple, Tuple, Optional, Dict
 from pypdf import PdfReader
 
+logger = logging.getLogger(__name__)
+
 # =====================================================
 # Small Talk / Greeting Detection (NON-ISO QUERIES)
 # =====================================================
@@ -14,14 +24,25 @@ GREETINGS = [
     "thanks", "thank you"
 ]
 
+SMALL_TALK_MESSAGE = (
+    "Hello! 😊 I'm doing well, thank you for asking.\n\n"
+    "I can help you with ISO 20022 messages such as pain.001, pacs.004, camt.029 – "
+    "including definitions, functionality, constraints, structure, and message building blocks.\n\n"
+    "Whenever you're ready, just ask!"
+)
+_SMALL_TALK_REPLY = "CHAT:SMALL_TALK|" + SMALL_TALK_MESSAGE
+
+# Greetings only count at the start of the query; str.startswith takes them all at once
+_GREETING_PREFIXES = tuple(GREETINGS)
+
 def is_small_talk(query: str) -> bool:
     q = (query or "").lower().strip()
-    return any(q == g or q.startswith(g) for g in GREETINGS)
+    return q.startswith(_GREETING_PREFIXES)
 
 # =====================================================
 # Message Definitions
 # =====================================================
-MESSAGE_DEFINITIONS: Dict[str, str] = {
+MESSAGE_DEFINITIONS: Mapping[str, str] = {
     "pain.001": "CustomerCreditTransferInitiation – customer-to-bank credit transfer initiation.",
     "pain.002": "CustomerPaymentStatusReport – status on previously sent customer payments.",
     "pain.007": "CustomerPaymentReversal – reversal of a previously executed customer payment.",
@@ -54,8 +75,8 @@ MESSAGE_DEFINITIONS: Dict[str, str] = {
     "camt.056": "FIToFIPaymentCancellationRequest – interbank payment cancellation request.",
     "camt.087": "RequestToModifyPayment – request to modify a payment.",
 }
-MESSAGE_CODES = set(MESSAGE_DEFINITIONS.keys())
-MESSAGE_FILE_MAP: Dict[str, str] = {
+MESSAGE_CODES = frozenset(MESSAGE_DEFINITIONS)
+MESSAGE_FILE_MAP: Mapping[str, str] = {
     "pain": "pain_messages.pdf",
     "pacs": "pacs_messages.pdf",
     "camt": "camt_messages.pdf",
@@ -63,7 +84,7 @@ MESSAGE_FILE_MAP: Dict[str, str] = {
 # =====================================================
 # TOC Data
 # =====================================================
-SECTION_START_PAGES: Dict[str, Dict[str, int]] = {
+SECTION_START_PAGES: Mapping[str, Mapping[str, int]] = {
     "pacs.002": {"functionality": 6, "structure": 7, "constraints": 11, "blocks": 15},
     "pacs.003": {"functionality": 79, "structure": 80, "constraints": 83, "blocks": 87},
     "pacs.004": {"functionality": 145, "structure": 146, "constraints": 157, "blocks": 164},
@@ -96,7 +117,7 @@ SECTION_START_PAGES: Dict[str, Dict[str, int]] = {
     "camt.056": {"functionality": 1057, "structure": 1060, "constraints": 1064, "blocks": 1067},
     "camt.087": {"functionality": 1144, "structure": 1147, "constraints": 1155, "blocks": 1157},
 }
-NEXT_MESSAGE_START_PAGE: Dict[str, int] = {
+NEXT_MESSAGE_START_PAGE: Mapping[str, int] = {
     "pacs.002": 79, "pacs.003": 145, "pacs.004": 353, "pacs.007": 440,
     "pacs.008": 520, "pacs.009": 653, "pacs.010": 686, "pacs.028": 743,
     "pain.001": 78, "pain.002": 163, "pain.007": 239, "pain.008": 309,
@@ -106,8 +127,55 @@ NEXT_MESSAGE_START_PAGE: Dict[str, int] = {
     "camt.038": 941, "camt.039": 959, "camt.055": 1057, "camt.056": 1144,
     "camt.087": 1291,
 }
+# The tables above are static: _MESSAGE_META and the memoized section bounds are
+# derived from them once, so they are exposed read-only
+MESSAGE_DEFINITIONS = MappingProxyType(MESSAGE_DEFINITIONS)
+MESSAGE_FILE_MAP = MappingProxyType(MESSAGE_FILE_MAP)
+SECTION_START_PAGES = MappingProxyType(
+    {code: MappingProxyType(pages) for code, pages in SECTION_START_PAGES.items()}
+)
+NEXT_MESSAGE_START_PAGE = MappingProxyType(NEXT_MESSAGE_START_PAGE)
 SECTION_ORDER = ["functionality", "structure", "constraints", "blocks"]
+_SECTION_IDX: Dict[str, int] = {s: i for i, s in enumerate(SECTION_ORDER)}
+
+class _MessageMeta(NamedTuple):
+    """Per-message response fields for answer_query, resolved once at import."""
+    header: str  # MESSAGE_CODE, DEFINITION and (if the PDF is known) PDF_FILE lines
+    blocks_page: Optional[int]
+    structure_page: Optional[int]
+
+def _message_meta(code: str, definition: str) -> _MessageMeta:
+    header = f"MESSAGE_CODE:{code}\nDEFINITION:{definition}"
+    pdf_filename = MESSAGE_FILE_MAP.get(code.partition(".")[0], "")
+    if pdf_filename:
+        header += f"\nPDF_FILE:{pdf_filename}"
+    pages = SECTION_START_PAGES.get(code, {})
+    return _MessageMeta(header, pages.get("blocks"), pages.get("structure"))
+
+_MESSAGE_META: Dict[str, _MessageMeta] = {
+    code: _message_meta(code, definition) for code, definition in MESSAGE_DEFINITIONS.items()
+}
+# Per PDF: cleaned page texts. Kept as str rather than encoded bytes: every
+# caller slices and regex-scans them as str, which stays cheap with no decoding.
 _PDF_CACHE: Dict[str, List[str]] = {}
+# Per PDF: search key -> sorted 1-based pages where find_term_in_section can hit.
+# "<tag>" keys (casefolded) come from block heading lines; bare word keys
+# (case-sensitive) are words followed by a capitalised word, as in "C17 Name".
+_TAG_INDEX: Dict[str, Dict[str, List[int]]] = {}
+_SECTION_CACHE: Dict[Tuple[str, str, str], str] = {}
+_DEFAULT_DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
+
+# Worker processes for the first text extraction of a PDF (1 = in-process).
+# pypdf is pure Python, so threads would serialize on the GIL; each worker
+# opens its own reader and extracts a contiguous page range.
+# Each worker re-imports this module and reopens the PDF, so the default is kept small.
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+_MIN_PAGES_PER_WORKER = 50
+# One worker pool at a time, so concurrent loads never exceed PDF_EXTRACT_WORKERS processes
+_extract_pool_lock = threading.Lock()
+# Per PDF: held while it is extracted, so concurrent first requests load it only once
+_PDF_LOAD_LOCKS: Dict[str, threading.Lock] = {}
+_pdf_load_locks_guard = threading.Lock()
 
 # =====================================================
 # FIX: Prevent GroupHeader <GrpHdr> building block spillover into child blocks
@@ -119,6 +187,72 @@ GRPHDR_STOP_TAGS = [
     "<Undrlyg>",
     "<Case>",
 ]
+_GRPHDR_STOP_TAGS_LOWER = tuple(tag.lower() for tag in GRPHDR_STOP_TAGS)
+
+# =====================================================
+# Precompiled patterns
+# =====================================================
+
+# PDF page cleanup
+_LINE_JOIN_RE = re.compile(r'(?<!\n)\n(?!\n|\s*[•A-Z0-9<])')
+_DOT_LEADER_RE = re.compile(r"\.{3,}")
+_MULTI_SPACE_RE = re.compile(r" {2,}")
+_EXCESS_BLANK_RE = re.compile(r"\n{3,}")
+# Guideline blocks, maintenance headers/footers, SEG approval lines,
+# message/version lines and month-year footers, removed in one pass.
+# Flags are scoped per branch: only the guideline branch spans lines and it
+# stays case-sensitive. The leading lookahead rejects positions that cannot
+# start any branch before the alternation is tried; the line branches use
+# [^\n] so a failed attempt never looks past the end of its line.
+_BOILERPLATE_RE = re.compile(
+    r'(?=[GPpAaCcJjFfMmSsOoNnDd])(?:'
+    r'(?s:Guideline:.*?(?=\n[A-Z]|\n\nC\d+|$))'
+    r'|(?i:Payments\s+[^\n]*?Maintenance\s+\d{4}\s*-\s*\d{4}[^\n]*(?:\n|$))'
+    r'|(?i:Approved\s+by\s+the\s+Payments\s+SEG[^\n]*(?:\n|$))'
+    r'|(?i:(?:pain|pacs|camt)\.\d{3}\.\d{3}\.\d+\s+[^\n]*(?:\n|$))'
+    r'|(?i:(?:J(?:anuary|une|uly)|February|Ma(?:rch|y)|A(?:pril|ugust)|September|October|November|December)\s+\d{4})'
+    r')'
+)
+
+# Query parsing
+_MSG_CODE_RE = re.compile(r"\b(pain|pacs|camt)[\s.\-]?(\d{3})\b")
+_XML_TAG_RE = re.compile(r'<[A-Za-z]+>')
+_XML_TAG_NAME_RE = re.compile(r"<([A-Za-z0-9]+)>")
+_CAPS_TERM_RE = re.compile(r"\b[A-Z][A-Z0-9_]{1,}\b")
+_CNUM_RE = re.compile(r"\bC\d+\b", re.IGNORECASE)
+_CAMEL_CASE_RE = re.compile(r"\b([A-Z][a-z]+(?:[A-Z][a-z]*)*)\b")
+
+# Term index
+_INDEX_WORD_RE = re.compile(r'\b(\w+)(?=\s+[A-Z][a-zA-Z])')
+# Any tag that ends a block heading line, numbered ("4.4.1 Assignment <Assgnmt>")
+# or not: the union of find_term_in_section's two heading patterns, one scan per page
+_HEADING_TAG_RE = re.compile(
+    r'(?mi)^\s*(?:\d+(?:\.\d+)+\s+[A-Za-z\s]+|[A-Z][A-Za-z\s]+)<\s*(\w+)\s*>\s*$'
+)
+_INDEXABLE_TERM_RE = re.compile(r'[A-Za-z0-9_]+')
+
+# Section slicing
+_NEXT_CONSTRAINT_RE = re.compile(r'\nC\d+\s+[A-Z]')
+_BLOCKS_HEADING_RE = re.compile(r'\n\s*\d+(?:\.\d+)*\s+Message\s+Building\s+Blocks', re.IGNORECASE)
+_NUMBERED_BLOCK_HEADING_RE = re.compile(r'\n\s*\d+(?:\.\d+)+\s+[A-Z][A-Za-z0-9\s]+?\s*<[^>]+>')
+_ANY_BLOCK_HEADING_RE = re.compile(r'\n\s*\d*(?:\.\d+)*\s*[A-Z][A-Za-z0-9\s]+?\s*<[^>]+>')
+_CONSTRAINTS_HEADING_RE = re.compile(r'^\s*\d+(?:\.\d+)*\s+Constraints\s*$', re.IGNORECASE | re.MULTILINE)
+_CONSTRAINTS_END_RES = tuple(
+    re.compile(p, re.IGNORECASE | re.MULTILINE) for p in (
+        r'\n\s*Message Building Blocks\s*\n',
+        r'\n\s*MessageBuildingBlocks\s*\n',
+        r'\n\s*Message\s+Building\s+Blocks\s*\n',
+        r'^\s*\d+(?:\.\d+)*\s+Message\s+Building\s+Blocks',
+        r'^\s*\d+(?:\.\d+)*\s+MessageBuildingBlocks',
+    )
+)
+_FUNCTIONALITY_END_RES = tuple(
+    re.compile(p, re.IGNORECASE | re.MULTILINE) for p in (
+        r'\n\s*\d+(?:\.\d+)*\s+Structure\s*\n',
+        r'\n\s*Structure\s*\n',
+        r'^\s*\d+(?:\.\d+)*\s+Structure\s*$',
+    )
+)
 
 # =====================================================
 # Utilities
@@ -130,129 +264,167 @@ def _clean_pdf_text(text: str) -> str:
         return ""
     text = text.replace("\r\n", "\n").replace("\r", "\n")
 
-    text = re.sub(
-        r'(?<!\n)\n(?!\n|\s*[•A-Z0-9<])',
-        ' ',
-        text
-    )
-    text = re.sub(r"\.{3,}", " ", text)
-    text = re.sub(r" {2,}", " ", text)
-    text = re.sub(r"\n{3,}", "\n\n", text)
-
-    # Remove guideline sections
-    text = re.sub(r'Guideline:.*?(?=\n[A-Z]|\n\nC\d+|$)', '', text, flags=re.DOTALL)
+    text = _LINE_JOIN_RE.sub(' ', text)
+    text = _DOT_LEADER_RE.sub(" ", text)
+    text = _MULTI_SPACE_RE.sub(" ", text)
+    text = _EXCESS_BLANK_RE.sub("\n\n", text)
 
     # -------------------------------------------------
-    # REMOVE PDF boilerplate (GLOBAL FIX)
+    # REMOVE guideline sections + PDF boilerplate (GLOBAL FIX)
     # -------------------------------------------------
+    text = _BOILERPLATE_RE.sub('', text)
 
-    # Maintenance headers / footers
-    text = re.sub(
-        r'Payments\s+.*?Maintenance\s+\d{4}\s*-\s*\d{4}.*?(?:\n|$)',
-        '',
-        text,
-        flags=re.IGNORECASE
-    )
-
-    # SEG approval lines
-    text = re.sub(
-        r'Approved\s+by\s+the\s+Payments\s+SEG.*?(?:\n|$)',
-        '',
-        text,
-        flags=re.IGNORECASE
-    )
-
-    # Message/version boilerplate lines
-    text = re.sub(
-        r'(pain|pacs|camt)\.\d{3}\.\d{3}\.\d+\s+.*?(?:\n|$)',
-        '',
-        text,
-        flags=re.IGNORECASE
-    )
+    return text.strip()
+def _extract_page_texts(reader: PdfReader, first: int, last: int) -> List[str]:
+    texts: List[str] = []
+    for i in range(first, last):
+        try:
+            texts.append(reader.pages[i].extract_text() or "")
+        except Exception:
+            texts.append("")
+    return texts
 
-    # Standalone month-year footers
-    text = re.sub(
-        r'(January|February|March|April|May|June|July|August|September|October|November|December)\s+\d{4}',
-        '',
-        text,
-        flags=re.IGNORECASE
-    )
+def _extract_pdf_range(path: str, first: int, last: int) -> List[str]:
+    """Raw text of pages [first, last); runs in a worker process."""
+    with open(path, "rb") as fh:
+        return _extract_page_texts(PdfReader(fh, strict=False), first, last)
 
-    return text.strip()
 def _load_pdf_pages(path: str) -> List[str]:
+    """Cleaned text of every page; extraction and cleanup run once per PDF."""
     if path in _PDF_CACHE:
         return _PDF_CACHE[path]
-    reader = PdfReader(path)
-    pages: List[str] = []
-    for page in reader.pages:
-        try:
-            pages.append(page.extract_text() or "")
-        except Exception:
-            pages.append("")
-    _PDF_CACHE[path] = pages
+    with _pdf_load_locks_guard:
+        load_lock = _PDF_LOAD_LOCKS.setdefault(path, threading.Lock())
+    with load_lock:
+        # Another request may have loaded it while this one waited
+        if path in _PDF_CACHE:
+            return _PDF_CACHE[path]
+        pages = _read_pdf_pages(path)
+        _TAG_INDEX[path] = _index_page_terms(pages)
+        _PDF_CACHE[path] = pages
     return pages
+
+def _read_pdf_pages(path: str) -> List[str]:
+    """Extract and clean every page, on worker processes for large PDFs."""
+    # Given a path, pypdf first copies the whole file into memory; reading
+    # from an open handle lets it seek to the objects each page needs.
+    with open(path, "rb") as fh:
+        reader = PdfReader(fh, strict=False)
+        page_count = len(reader.pages)
+        workers = min(PDF_EXTRACT_WORKERS, page_count // _MIN_PAGES_PER_WORKER)
+
+        if workers > 1:
+            step = -(-page_count // workers)
+            firsts = range(0, page_count, step)
+            lasts = [min(first + step, page_count) for first in firsts]
+            # spawn, not fork: this can run on a request thread
+            with _extract_pool_lock, ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+                raw_pages = [t for chunk in pool.map(_extract_pdf_range, repeat(path), firsts, lasts) for t in chunk]
+        else:
+            raw_pages = _extract_page_texts(reader, 0, page_count)
+
+    return [_clean_pdf_text(text) for text in raw_pages]
+
+def _index_page_terms(pages: List[str]) -> Dict[str, List[int]]:
+    """
+    Map every key find_term_in_section could match to the pages it occurs on.
+    A superset of real hits: the per-page patterns still decide the match.
+    """
+    index: Dict[str, List[int]] = {}
+    for page_num, text in enumerate(pages, start=1):
+        keys = set(_INDEX_WORD_RE.findall(text))
+        keys.update(f"<{tag.casefold()}>" for tag in _HEADING_TAG_RE.findall(text))
+        for key in keys:
+            index.setdefault(key, []).append(page_num)
+    return index
+
+def _indexed_pages(index: Dict[str, List[int]], term: str, first: int, last: int) -> List[int]:
+    """
+    Pages in [first, last] where term can hit, from its word and "<tag>" postings.
+    Postings are sorted, so the section range is cut out by bisection rather than
+    filtering every page a common word occurs on.
+    """
+    pages = set()
+    for postings in (index.get(term, ()), index.get(f"<{term.casefold()}>", ())):
+        pages.update(postings[bisect_left(postings, first):bisect_right(postings, last)])
+    return sorted(pages)
+@lru_cache(maxsize=256)
+def _message_pdf_path(message_code: str, data_dir: Optional[str] = None) -> Optional[str]:
+    """
+    Path of the PDF holding message_code ("pacs.008" -> .../pacs_messages.pdf), or None if missing.
+    The PDFs ship with the app, so one prefix lookup and stat per code is enough.
+    """
+    pdf_filename = MESSAGE_FILE_MAP.get(message_code.partition(".")[0])
+    if not pdf_filename:
+        return None
+    pdf_path = os.path.join(data_dir or _DEFAULT_DATA_DIR, pdf_filename)
+    return pdf_path if os.path.exists(pdf_path) else None
+@lru_cache(maxsize=None)
 def _get_section_page_bounds(message_code: str, section: str) -> Optional[Tuple[int, int]]:
     """
-    Get page bounds for a section.
+    Get page bounds for a section (memoized: the TOC tables are static).
     CRITICAL FIX: For constraints and functionality, read until the NEXT section heading is found,
     not just until the page where next section starts.
     """
-    if message_code not in SECTION_START_PAGES:
+    section_pages = SECTION_START_PAGES.get(message_code)
+    if section_pages is None:
         return None
-    section_pages = SECTION_START_PAGES[message_code]
     if section not in section_pages:
         return None
     
+    idx = _SECTION_IDX.get(section)
+    if idx is None:
+        return None
+
     start_page = section_pages[section]
-    
-    # CRITICAL FIX: For constraints and functionality, include next section start page for extraction
-    # We'll filter by actual heading in get_pages_content()
-    if section in ["constraints", "functionality"]:
-        try:
-            idx = SECTION_ORDER.index(section)
-        except ValueError:
-            return None
-        
-        if idx < len(SECTION_ORDER) - 1:
-            next_section = SECTION_ORDER[idx + 1]
-            next_start = section_pages.get(next_section, NEXT_MESSAGE_START_PAGE[message_code])
-            # Include the next section's start page in extraction range
-            end_page = next_start
-        else:
-            next_start = NEXT_MESSAGE_START_PAGE[message_code]
-            end_page = next_start - 1
+    if idx < len(SECTION_ORDER) - 1:
+        next_start = section_pages.get(SECTION_ORDER[idx + 1], NEXT_MESSAGE_START_PAGE[message_code])
+        # CRITICAL FIX: For constraints and functionality, include next section start page for extraction
+        # We'll filter by actual heading in get_pages_content()
+        if section in ("constraints", "functionality"):
+            return start_page, next_start
     else:
-        # Normal logic for other sections
-        try:
-            idx = SECTION_ORDER.index(section)
-        except ValueError:
-            return None
-        
-        if idx < len(SECTION_ORDER) - 1:
-            next_section = SECTION_ORDER[idx + 1]
-            next_start = section_pages.get(next_section, NEXT_MESSAGE_START_PAGE[message_code])
-        else:
-            next_start = NEXT_MESSAGE_START_PAGE[message_code]
-        
-        end_page = next_start - 1
-    
-    return start_page, end_page
+        next_start = NEXT_MESSAGE_START_PAGE[message_code]
+
+    return start_page, next_start - 1
 # =====================================================
 # Extract message codes
 # =====================================================
-def extract_message_codes(query: str) -> List[str]:
-    q = query.lower()
-    matches = re.findall(r"\b(pain|pacs|camt)[\s.\-]?(\d{3})\b", q)
-    codes: List[str] = []
-    for prefix, num in matches:
-        code = f"{prefix}.{num}"
-        if code in MESSAGE_DEFINITIONS:
-            codes.append(code)
-    return list(dict.fromkeys(codes))
+@lru_cache(maxsize=1024)
+def extract_message_codes(query: str) -> Tuple[str, ...]:
+    # One scan; known codes only, deduplicated in order of first mention
+    codes = (f"{prefix}.{num}" for prefix, num in _MSG_CODE_RE.findall(query.lower()))
+    return tuple(dict.fromkeys(code for code in codes if code in MESSAGE_DEFINITIONS))
 # =====================================================
 # Intent Detection
 # =====================================================
-def detect_query_intent(query: str) -> Tuple[str, List[str], bool]:
+# Known message codes as one alternation factored by family
+# ("camt\.(?:026|027|...)|pacs\.(?:...)"), so a position that does not start
+# a family name fails after one comparison instead of one per code
+_ANY_MSG_CODE = "|".join(
+    rf"{family}\.(?:{'|'.join(code.partition('.')[2] for code in group)})"
+    for family, group in groupby(sorted(MESSAGE_CODES), key=lambda code: code.partition(".")[0])
+)
+
+# Every keyword the intent rules test for, found in one scan of the lowercased
+# query. The alternation sits in a lookahead so hits at overlapping positions
+# are all reported. Matching stays substring-based like the original checks
+# (so "constraints" and "rules" still count), except the "all" keywords, which
+# must be whole words so "completed" or "completely" do not fetch every section.
+_INTENT_RE = re.compile(
+    r'(?=(?P<structure>structure)'
+    r'|(?P<blocks>message building block|building blocks)'
+    r'|(?P<block_name>assignment|grouphdr|case|underlying|justification)'
+    r'|(?P<constraint>constraint|rule)'
+    r'|(?P<cnum>\bc\d+\b)'
+    r'|(?P<all>\b(?:everything|complete)\b|all information)'
+    r'|(?P<field>what is|explain|describe|tell me about|definition of|show)'
+    r'|(?P<tag><[a-z]+>)'
+    r'|(?P<code>' + _ANY_MSG_CODE + r'))'
+)
+
+@lru_cache(maxsize=1024)
+def detect_query_intent(query: str) -> Tuple[str, Tuple[str, ...], bool]:
     """
     Returns (intent, sections_to_fetch, wants_details)
     
@@ -261,124 +433,100 @@ def detect_query_intent(query: str) -> Tuple[str, List[str], bool]:
     ALWAYS return 'functionality_full' intent to show complete MessageDefinition content.
     """
     q = query.lower()
+    hits = {m.lastgroup for m in _INTENT_RE.finditer(q)}
     
     # =====================================================
     # STRUCTURE FIX (location-only)
     # If user asks for structure of a message, return ONLY the TOC-based
     # page location + PDF link (no table extraction, no LLM).
     # =====================================================
-    if "structure" in q:
-        return "structure_location", ["structure"], False
+    if "structure" in hits:
+        return "structure_location", ("structure",), False
 
-    # Location-only indicators
-    location_indicators = ["where", "which page", "locate", "find"]
-    wants_location_only = any(kw in q for kw in location_indicators) and \
-                          not any(kw in q for kw in ["show", "give", "explain", "describe", "what is"])
-    
     # EXPLICIT section requests (user specifically asks for these sections)
     
     # =====================================================
     # Message Building Blocks
     # =====================================================
-    if any(kw in q for kw in ["message building block", "message building blocks", "building blocks"]):
+    if "blocks" in hits:
         # If user mentions a specific block name or XML tag -> extract details
-        if re.search(r'<[A-Za-z]+>', q) or any(
-            kw in q for kw in ["assignment", "grouphdr", "case", "underlying", "justification"]
-        ):
-            return "specific_building_block", ["blocks"], True
+        if "tag" in hits or "block_name" in hits:
+            return "specific_building_block", ("blocks",), True
 
         # Otherwise -> LOCATION ONLY (page + PDF)
-        return "blocks_location", ["blocks"], False
+        return "blocks_location", ("blocks",), False
 
     # Constraints (explicit or C-number based, e.g. C17)
-    if any(kw in q for kw in ["constraint", "constraints", "rule", "rules"]) \
-       or re.search(r"\bC\d+\b", q, flags=re.IGNORECASE):
-       # If user asked for a specific constraint like C17
-       if re.search(r"\bC\d+\b", q, flags=re.IGNORECASE):
-           return "constraints", ["constraints"], True
-       # GENERAL constraint queries → ALWAYS list all constraints
-       return "constraints", ["constraints"], True
+    # GENERAL constraint queries → ALWAYS list all constraints
+    if "constraint" in hits or "cnum" in hits:
+        return "constraints", ("constraints",), True
     
     # All details
-    if any(kw in q for kw in ["everything", "complete", "all information"]):
-        return "all", ["functionality", "structure", "constraints", "blocks"], True
-    
-    # Specific field queries (asking about a particular XML tag or field)
-    specific_indicators = ["what is", "explain", "describe", "tell me about", "definition of", "show"]
-    has_field_query = any(kw in q for kw in specific_indicators)
-    has_message_code = any(code in q for code in MESSAGE_CODES)
+    if "all" in hits:
+        return "all", ("functionality", "structure", "constraints", "blocks"), True
     
-    # Check if asking about a specific field/element (contains XML tag or specific term after "what is")
-    has_specific_element = bool(re.search(r'<[A-Za-z]+>', q)) or \
-                          (has_field_query and len([w for w in q.split() if w[0].isupper()]) > 1)
-    
-    if has_field_query and has_message_code and has_specific_element:
-        return "specific_field", ["structure", "blocks", "constraints"], True
+    # Specific field queries: question phrasing + message code + XML tag
+    if "field" in hits and "code" in hits and "tag" in hits:
+        return "specific_field", ("structure", "blocks", "constraints"), True
     
     # DEFAULT: General questions about the message
-    return "functionality_full", ["functionality"], True
+    return "functionality_full", ("functionality",), True
 # =====================================================
 # Term extraction
 # =====================================================
-def extract_search_terms(query: str) -> List[str]:
+@lru_cache(maxsize=1024)
+def extract_search_terms(query: str) -> Tuple[str, ...]:
     """Extract constraint names, XML tags, field names, building block names"""
     candidates: List[str] = []
     q = query.strip()
     
     # XML tags like <Assgnmt>, <GrpHdr>
-    tag_matches = re.findall(r"<([A-Za-z0-9]+)>", q)
+    tag_matches = _XML_TAG_NAME_RE.findall(q)
     candidates.extend(tag_matches)
     
     # Uppercase terms: BICFI, C14, IBAN
-    caps_matches = re.findall(r"\b[A-Z][A-Z0-9_]{1,}\b", q)
+    caps_matches = _CAPS_TERM_RE.findall(q)
     candidates.extend(caps_matches)
     
     # Constraint codes: C14, C82
-    constraint_matches = re.findall(r"\bC\d+\b", q, flags=re.IGNORECASE)
+    constraint_matches = _CNUM_RE.findall(q)
     candidates.extend([m.upper() for m in constraint_matches])
     
     # CamelCase words
-    camel_case_matches = re.findall(r"\b([A-Z][a-z]+(?:[A-Z][a-z]*)*)\b", q)
+    camel_case_matches = _CAMEL_CASE_RE.findall(q)
     candidates.extend(camel_case_matches)
     
-    # Compound names with spaces
-    words = q.split()
-    for i in range(len(words)):
-        for length in range(2, 5):
-            if i + length <= len(words):
-                phrase = words[i:i+length]
-                if all(word[0].isupper() for word in phrase if word):
-                    compound = ''.join(word.capitalize() for word in phrase)
-                    candidates.append(compound)
+    # Compound names with spaces: every 2-4 word window inside a run of
+    # capitalised words ("Group Header" -> "GroupHeader")
+    for capitalised, group in groupby(q.split(), key=lambda word: word[0].isupper()):
+        if not capitalised:
+            continue
+        run = [word.capitalize() for word in group]
+        for i in range(len(run) - 1):
+            for length in range(2, min(5, len(run) - i + 1)):
+                candidates.append("".join(run[i:i + length]))
     
-    return list(dict.fromkeys(candidates))
+    return tuple(dict.fromkeys(candidates))
 
+@lru_cache(maxsize=1024)
 def find_term_in_section(
     message_code: str,
     section: str,
-    search_terms: List[str],
+    search_terms: Tuple[str, ...],
     data_dir: Optional[str] = None
 ) -> Optional[Tuple[int, str, str]]:
     """
     Find page where term appears and extract content.
     Returns (page_number, extracted_content, matched_term) or None
+    Memoized: search_terms must be a tuple, as extract_search_terms returns.
     
     CRITICAL FIX: Improved building block matching to find exact element by XML tag.
     """
     if not search_terms:
         return None
         
-    if data_dir is None:
-        backend_root = os.path.dirname(os.path.dirname(__file__))
-        data_dir = os.path.join(backend_root, "data")
-    
-    prefix = message_code.split(".")[0]
-    pdf_filename = MESSAGE_FILE_MAP.get(prefix)
-    if not pdf_filename:
-        return None
-    
-    pdf_path = os.path.join(data_dir, pdf_filename)
-    if not os.path.exists(pdf_path):
+    pdf_path = _message_pdf_path(message_code, data_dir)
+    if not pdf_path:
         return None
     
     bounds = _get_section_page_bounds(message_code, section)
@@ -388,126 +536,179 @@ def find_term_in_section(
     start_page, end_page = bounds
     all_pages = _load_pdf_pages(pdf_path)
 
-    def _page_window(start_num: int, max_pages: int = 3) -> str:
-        """Return concatenated cleaned text for start page + following pages (handles page breaks)."""
-        chunks = []
+    def _page_window(
+        start_num: int, start_idx: int, next_heading_re: re.Pattern, max_pages: int = 3
+    ) -> Tuple[str, int]:
+        """
+        Cleaned text from the heading page on (handles page breaks) and where the
+        block ends in it: at the next heading, else 8000 chars on. Following pages
+        are only appended while that heading has not shown up yet.
+        """
         last = min(start_num + max_pages - 1, end_page, len(all_pages))
-        for p in range(start_num, last + 1):
-            cleaned = _clean_pdf_text(all_pages[p - 1])
-            if cleaned:
-                chunks.append(cleaned)
-        return "\n\n".join(chunks)
+        window_text = all_pages[start_num - 1]
+        next_heading = next_heading_re.search(window_text, start_idx + 1)
+        for p in range(start_num + 1, last + 1):
+            if next_heading:
+                break
+            if all_pages[p - 1]:
+                window_text += "\n\n" + all_pages[p - 1]
+                next_heading = next_heading_re.search(window_text, start_idx + 1)
+        if next_heading:
+            return window_text, next_heading.start()
+        return window_text, min(len(window_text), start_idx + 8000)
+
+    last_page = min(end_page, len(all_pages))
+    index = _TAG_INDEX.get(pdf_path)
 
     for term in search_terms:
         term_lower = term.lower()
+        esc = re.escape(term)
+        constraint_re = re.compile(rf'\b{esc}\s+[A-Z][a-zA-Z]+')
+        exact_re = re.compile(rf'(?mi)^\s*\d+(?:\.\d+)+\s+[A-Za-z\s]+<\s*{esc}\s*>\s*$')
+        simple_re = re.compile(rf'(?mi)^\s*[A-Z][A-Za-z\s]+<\s*{esc}\s*>\s*$')
+
+        # Only visit pages the index says can match; odd terms scan the section
+        if index is not None and _INDEXABLE_TERM_RE.fullmatch(term):
+            page_nums = _indexed_pages(index, term, start_page, last_page)
+        else:
+            page_nums = range(start_page, last_page + 1)
         
-        for page_num in range(start_page, min(end_page + 1, len(all_pages) + 1)):
-            page_text = all_pages[page_num - 1]
-            page_text_clean = _clean_pdf_text(page_text)
-            page_text_lower = page_text_clean.lower()
+        for page_num in page_nums:
+            page_text_clean = all_pages[page_num - 1]
             
             # PATTERN 1: Constraint heading
-            constraint_pattern = rf'\b{re.escape(term)}\s+[A-Z][a-zA-Z]+'
-            if re.search(constraint_pattern, page_text_clean):
-                match = re.search(constraint_pattern, page_text_clean)
-                if match:
-                    start_idx = match.start()
+            match = constraint_re.search(page_text_clean)
+            if match:
+                start_idx = match.start()
                     
-                    # Look for next constraint OR "Message Building Blocks" heading
-                    next_constraint = re.search(r'\nC\d+\s+[A-Z]', page_text_clean[start_idx+10:])
-                    blocks_heading = re.search(
-                        r'\n\s*\d+(?:\.\d+)*\s+Message\s+Building\s+Blocks',
-                        page_text_clean[start_idx+10:],
-                        re.IGNORECASE
-                    )
+                # Look for next constraint OR "Message Building Blocks" heading
+                next_constraint = _NEXT_CONSTRAINT_RE.search(page_text_clean[start_idx+10:])
+                blocks_heading = _BLOCKS_HEADING_RE.search(page_text_clean[start_idx+10:])
                     
-                    # Use whichever comes first
-                    end_positions = []
-                    if next_constraint:
-                        end_positions.append(start_idx + 10 + next_constraint.start())
-                    if blocks_heading:
-                        end_positions.append(start_idx + 10 + blocks_heading.start())
+                # Use whichever comes first
+                end_positions = []
+                if next_constraint:
+                    end_positions.append(start_idx + 10 + next_constraint.start())
+                if blocks_heading:
+                    end_positions.append(start_idx + 10 + blocks_heading.start())
                     
-                    if end_positions:
-                        end_idx = min(end_positions)
-                    else:
-                        end_idx = len(page_text_clean)
+                if end_positions:
+                    end_idx = min(end_positions)
+                else:
+                    end_idx = len(page_text_clean)
                     
-                    extracted = page_text_clean[start_idx:end_idx]
-                    return page_num, extracted, term
+                extracted = page_text_clean[start_idx:end_idx]
+                return page_num, extracted, term
             
             # PATTERN 2: Building block heading with EXACT XML TAG MATCH
             # This is critical - we must match the EXACT XML tag to avoid confusion
             # e.g., "Assignment <Assgnmt>" should NOT match "Underlying <Undrlyg>"
             
             # Try exact numbered heading: "4.4.1 Assignment <Assgnmt>"
-            exact_pattern = rf'(?mi)^\s*\d+(?:\.\d+)+\s+[A-Za-z\s]+<\s*{re.escape(term)}\s*>\s*$'
-            exact_match = re.search(exact_pattern, page_text_clean, re.MULTILINE)
+            exact_match = exact_re.search(page_text_clean)
             
             if exact_match:
-                # Build a multi-page window starting at the heading page, because
-                # Definition/Usage often continues onto the next page in the PDF.
-                window_text = _page_window(page_num, max_pages=3)
+                # Multi-page window from the heading page, because Definition/Usage
+                # often continues onto the next page in the PDF. It ends at the next
+                # building block heading (numbered like "4.4.1.2 ... <Tag>").
                 start_idx = exact_match.start()
-
-                # Find the next building block heading (numbered like "4.4.1.2 ... <Tag>")
-                next_heading = re.search(
-                    r'\n\s*\d+(?:\.\d+)+\s+[A-Z][A-Za-z0-9\s]+?\s*<[^>]+>',
-                    window_text[start_idx + 1:],
-                )
-
-                if next_heading:
-                    end_idx = start_idx + 1 + next_heading.start()
-                else:
-                    end_idx = min(len(window_text), start_idx + 8000)
+                window_text, end_idx = _page_window(page_num, start_idx, _NUMBERED_BLOCK_HEADING_RE)
 
                 # Special handling for GroupHeader to prevent spillover into child blocks
                 if term_lower in ['grphdr', 'groupheader']:
-                    tail = window_text[start_idx:end_idx]
-                    stop_positions = []
-                    for _tag in GRPHDR_STOP_TAGS:
-                        _m = re.search(re.escape(_tag), tail, re.IGNORECASE)
-                        if _m:
-                            stop_positions.append(_m.start())
+                    # Literal tags: plain find on the lowercased block, no regex
+                    tail = window_text[start_idx:end_idx].lower()
+                    stop_positions = [pos for tag in _GRPHDR_STOP_TAGS_LOWER if (pos := tail.find(tag)) != -1]
                     if stop_positions:
                         end_idx = start_idx + min(stop_positions)
 
                 extracted = window_text[start_idx:end_idx]
-                print(f"[DEBUG] Found exact match for <{term}> on page {page_num}")
+                logger.debug("Found exact match for <%s> on page %d", term, page_num)
                 return page_num, extracted, term
             
             # PATTERN 3: Without numbering but with exact XML tag
-            simple_pattern = rf'(?mi)^\s*[A-Z][A-Za-z\s]+<\s*{re.escape(term)}\s*>\s*$'
-            simple_match = re.search(simple_pattern, page_text_clean, re.MULTILINE)
+            simple_match = simple_re.search(page_text_clean)
             
             if simple_match:
-                # Build a multi-page window starting at the heading page, because
-                # Definition/Usage often continues onto the next page in the PDF.
-                window_text = _page_window(page_num, max_pages=3)
+                # Multi-page window from the heading page, ending at the next
+                # (possible) heading
                 start_idx = simple_match.start()
-
-                # Find next (possible) heading
-                next_heading = re.search(
-                    r'\n\s*\d*(?:\.\d+)*\s*[A-Z][A-Za-z0-9\s]+?\s*<[^>]+>',
-                    window_text[start_idx + 1:],
-                )
-
-                if next_heading:
-                    end_idx = start_idx + 1 + next_heading.start()
-                else:
-                    end_idx = min(len(window_text), start_idx + 8000)
+                window_text, end_idx = _page_window(page_num, start_idx, _ANY_BLOCK_HEADING_RE)
 
                 extracted = window_text[start_idx:end_idx]
-                print(f"[DEBUG] Found simple match for <{term}> on page {page_num}")
+                logger.debug("Found simple match for <%s> on page %d", term, page_num)
                 return page_num, extracted, term
     
-    print(f"[DEBUG] No match found for terms: {search_terms}")
+    logger.debug("No match found for terms: %s", search_terms)
+    return None
+
+def find_term_in_sections(
+    message_code: str,
+    sections: Tuple[str, ...],
+    search_terms: Tuple[str, ...],
+    data_dir: Optional[str] = None
+) -> Optional[Tuple[int, str, str]]:
+    """First find_term_in_section hit over sections, in the given priority order."""
+    if not search_terms:
+        return None
+    for section in sections:
+        target_info = find_term_in_section(message_code, section, search_terms, data_dir)
+        if target_info:
+            return target_info
     return None
 
 # =====================================================
 # Content extraction - CRITICAL FIX FOR CONSTRAINTS AND FUNCTIONALITY
 # =====================================================
+def _join_pages_until(
+    pages: List[str],
+    end_patterns: Tuple[re.Pattern, ...],
+    start_pattern: Optional[re.Pattern] = None,
+) -> str:
+    """
+    "\n\n"-join the non-empty pages, drop everything up to start_pattern and
+    cut at the earliest end_patterns match, adding pages only until the cut
+    is known. A hit is confirmed with one more page so headings that straddle
+    a page break resolve exactly as in the fully joined text.
+    """
+    pages = iter([p for p in pages if p])
+    text = ""
+
+    def earliest_end() -> Optional[int]:
+        starts = [m.start() for m in (p.search(text) for p in end_patterns) if m]
+        return min(starts) if starts else None
+
+    if start_pattern is not None:
+        m = None
+        for page in pages:
+            text += "\n\n" + page
+            m = start_pattern.search(text)
+            if m:
+                break
+        if m:
+            text += "".join("\n\n" + p for p in islice(pages, 1))
+            text = text[start_pattern.search(text).end():]
+
+    pos = earliest_end()
+    for page in pages:
+        text += "\n\n" + page
+        if pos is not None:
+            pos = earliest_end()
+            break
+        pos = earliest_end()
+    return (text[:pos] if pos is not None else text).strip()
+
 def get_pages_content(message_code: str, section: str, data_dir: Optional[str] = None) -> str:
+    """Section text for a message; sliced from the PDF once, then served from memory."""
+    data_dir = data_dir or _DEFAULT_DATA_DIR
+    key = (message_code, section, data_dir)
+    content = _SECTION_CACHE.get(key)
+    if content is None:
+        content = _extract_pages_content(message_code, section, data_dir)
+        _SECTION_CACHE[key] = content
+    return content
+
+def _extract_pages_content(message_code: str, section: str, data_dir: Optional[str] = None) -> str:
     """
     Extract FULL content from section.
     
@@ -515,17 +716,8 @@ def get_pages_content(message_code: str, section: str, data_dir: Optional[str] =
     not at the page boundary. This ensures all content is captured even if it extends into 
     the page where the next section starts.
     """
-    if data_dir is None:
-        backend_root = os.path.dirname(os.path.dirname(__file__))
-        data_dir = os.path.join(backend_root, "data")
-    
-    prefix = message_code.split(".")[0]
-    pdf_filename = MESSAGE_FILE_MAP.get(prefix)
-    if not pdf_filename:
-        return ""
-    
-    pdf_path = os.path.join(data_dir, pdf_filename)
-    if not os.path.exists(pdf_path):
+    pdf_path = _message_pdf_path(message_code, data_dir)
+    if not pdf_path:
         return ""
     
     bounds = _get_section_page_bounds(message_code, section)
@@ -537,88 +729,61 @@ def get_pages_content(message_code: str, section: str, data_dir: Optional[str] =
     
     # Special handling for constraints section
     if section == "constraints":
-        full_text = ""
-        for page_num in range(start_page - 1, min(end_page, len(all_pages))):
-            cleaned = _clean_pdf_text(all_pages[page_num])
-            if cleaned:
-                full_text += "\n\n" + cleaned
-
-        # 🔧 FIX: Start strictly from Constraints heading (e.g. "3.3 Constraints")
-        m = re.search(r'^\s*\d+(?:\.\d+)*\s+Constraints\s*$', full_text, re.IGNORECASE | re.MULTILINE)
-        if m:
-            full_text = full_text[m.end():]
-
-        # Find "Message Building Blocks" heading and stop there
-        patterns = [
-            r'\n\s*Message Building Blocks\s*\n',
-            r'\n\s*MessageBuildingBlocks\s*\n',
-            r'\n\s*Message\s+Building\s+Blocks\s*\n',
-            r'^\s*\d+(?:\.\d+)*\s+Message\s+Building\s+Blocks',
-            r'^\s*\d+(?:\.\d+)*\s+MessageBuildingBlocks',
-        ]
-        
-        earliest_match_pos = len(full_text)
-        for pattern in patterns:
-            match = re.search(pattern, full_text, re.IGNORECASE | re.MULTILINE)
-            if match:
-                earliest_match_pos = min(earliest_match_pos, match.start())
-        
-        if earliest_match_pos < len(full_text):
-            return full_text[:earliest_match_pos].strip()
-        
-        return full_text.strip()
+        # 🔧 FIX: Start strictly from Constraints heading (e.g. "3.3 Constraints"),
+        # stop at the "Message Building Blocks" heading
+        return _join_pages_until(
+            all_pages[start_page - 1:end_page], _CONSTRAINTS_END_RES, start_pattern=_CONSTRAINTS_HEADING_RE
+        )
     
     # Special handling for functionality section
     if section == "functionality":
-        full_text = ""
-        for page_num in range(start_page - 1, min(end_page, len(all_pages))):
-            cleaned = _clean_pdf_text(all_pages[page_num])
-            if cleaned:
-                full_text += "\n\n" + cleaned
-        
         # Find "Structure" heading and stop there
-        patterns = [
-            r'\n\s*\d+(?:\.\d+)*\s+Structure\s*\n',
-            r'\n\s*Structure\s*\n',
-            r'^\s*\d+(?:\.\d+)*\s+Structure\s*$',
-        ]
-        
-        earliest_match_pos = len(full_text)
-        for pattern in patterns:
-            match = re.search(pattern, full_text, re.IGNORECASE | re.MULTILINE)
-            if match:
-                earliest_match_pos = min(earliest_match_pos, match.start())
-        
-        if earliest_match_pos < len(full_text):
-            return full_text[:earliest_match_pos].strip()
-        
-        return full_text.strip()
+        return _join_pages_until(all_pages[start_page - 1:end_page], _FUNCTIONALITY_END_RES)
 
-    # Normal extraction for other sections
-    parts: List[str] = []
-    for page_num in range(start_page - 1, min(end_page, len(all_pages))):
-        cleaned = _clean_pdf_text(all_pages[page_num])
-        if cleaned:
-            parts.append(cleaned)
-    
-    return "\n\n".join(parts)
+    # Normal extraction for other sections: pages are cleaned at load, so this
+    # is a single join over the non-empty ones
+    return "\n\n".join(filter(None, all_pages[start_page - 1:end_page]))
 # =====================================================
 # Main Entry Point
 # =====================================================
+@lru_cache(maxsize=None)
+def _section_page_lines(message_code: str, sections: Tuple[str, ...]) -> Tuple[str, ...]:
+    """SECTION_PAGES header lines for a message; static TOC data, so built once per intent."""
+    lines = []
+    for section in sections:
+        bounds = _get_section_page_bounds(message_code, section)
+        if bounds:
+            start_page, end_page = bounds
+            lines.append(f"SECTION_PAGES:{section.upper()}:{start_page}-{end_page}")
+    return tuple(lines)
+
+# Fixed response lines (main.py splits on the same content markers)
+_CONTENT_START = "---CONTENT_START---"
+_CONTENT_END = "---CONTENT_END---"
+_WANTS_DETAILS_TRUE = "WANTS_DETAILS:true"
+_WANTS_DETAILS_FALSE = "WANTS_DETAILS:false"
+
+def _location_response(meta: _MessageMeta, intent: str, page: Optional[int], term: str) -> str:
+    """Header-only response pointing at a TOC page (fixed lines, empty content); no PDF extraction."""
+    target_lines = f"TARGET_PAGE:{page}\nTARGET_TERM:{term}\n" if page else ""
+    return (
+        f"{meta.header}\nQUERY_INTENT:{intent}\n{_WANTS_DETAILS_FALSE}\n"
+        f"{target_lines}{_CONTENT_START}\n{_CONTENT_END}"
+    )
+
 def answer_query(query: str) -> str:
-    """Main entry point"""
+    """
+    Main entry point
+
+    Not memoized: main.py already caches answers by normalized query, and the
+    section slicing underneath is cached in _SECTION_CACHE.
+    """
 
     # =====================================================
     # Handle small talk / greetings BEFORE ISO logic
     # =====================================================
     if is_small_talk(query):
-        return (
-            "CHAT:SMALL_TALK|"
-            "Hello! 😊 I'm doing well, thank you for asking.\n\n"
-            "I can help you with ISO 20022 messages such as pain.001, pacs.004, camt.029 – "
-            "including definitions, functionality, constraints, structure, and message building blocks.\n\n"
-            "Whenever you're ready, just ask!"
-        )
+        return _SMALL_TALK_REPLY
 
     codes = extract_message_codes(query)
     if not codes:
@@ -629,6 +794,7 @@ def answer_query(query: str) -> str:
         )
     
     message_code = codes[0]
+    meta = _MESSAGE_META[message_code]
     intent, sections, wants_details = detect_query_intent(query)
 
 
@@ -636,26 +802,7 @@ def answer_query(query: str) -> str:
     # MESSAGE BUILDING BLOCKS – location-only
     # =====================================================
     if intent == "blocks_location":
-        response_parts: List[str] = []
-        response_parts.append(f"MESSAGE_CODE:{message_code}")
-        response_parts.append(f"DEFINITION:{MESSAGE_DEFINITIONS.get(message_code, '')}")
-
-        prefix = message_code.split(".")[0]
-        pdf_filename = MESSAGE_FILE_MAP.get(prefix, "")
-        if pdf_filename:
-            response_parts.append(f"PDF_FILE:{pdf_filename}")
-
-        response_parts.append("QUERY_INTENT:blocks")
-        response_parts.append("WANTS_DETAILS:false")
-
-        blocks_page = SECTION_START_PAGES.get(message_code, {}).get("blocks")
-        if blocks_page:
-            response_parts.append(f"TARGET_PAGE:{blocks_page}")
-            response_parts.append("TARGET_TERM:Message Building Blocks")
-
-        response_parts.append("---CONTENT_START---")
-        response_parts.append("---CONTENT_END---")
-        return "\n".join(response_parts)
+        return _location_response(meta, "blocks", meta.blocks_page, "Message Building Blocks")
 
     
     # =====================================================
@@ -663,89 +810,79 @@ def answer_query(query: str) -> str:
     # Return only TOC-based page number + metadata. No PDF extraction.
     # =====================================================
     if intent == "structure_location":
-        response_parts: List[str] = []
-        response_parts.append(f"MESSAGE_CODE:{message_code}")
-        response_parts.append(f"DEFINITION:{MESSAGE_DEFINITIONS.get(message_code, '')}")
-
-        prefix = message_code.split(".")[0]
-        pdf_filename = MESSAGE_FILE_MAP.get(prefix, "")
-        if pdf_filename:
-            response_parts.append(f"PDF_FILE:{pdf_filename}")
-
-        response_parts.append("QUERY_INTENT:structure")
-        response_parts.append("WANTS_DETAILS:false")
-        structure_page = SECTION_START_PAGES.get(message_code, {}).get("structure")
-        if structure_page:
-            response_parts.append(f"TARGET_PAGE:{structure_page}")
-            response_parts.append("TARGET_TERM:Structure")
-
-        response_parts.append("---CONTENT_START---")
-        response_parts.append("---CONTENT_END---")
-        return "\n".join(response_parts)
-
-    response_parts: List[str] = []
-    response_parts.append(f"MESSAGE_CODE:{message_code}")
-    response_parts.append(f"DEFINITION:{MESSAGE_DEFINITIONS.get(message_code, '')}")
-    
-    prefix = message_code.split(".")[0]
-    pdf_filename = MESSAGE_FILE_MAP.get(prefix, "")
-    if pdf_filename:
-        response_parts.append(f"PDF_FILE:{pdf_filename}")
-    
-    response_parts.append(f"QUERY_INTENT:{intent}")
-    response_parts.append(f"WANTS_DETAILS:{'true' if wants_details else 'false'}")
+        return _location_response(meta, "structure", meta.structure_page, "Structure")
+
+    # Prebuilt message header first; the rest is added in whole runs
+    response_parts: List[str] = [
+        meta.header,
+        f"QUERY_INTENT:{intent}",
+        _WANTS_DETAILS_TRUE if wants_details else _WANTS_DETAILS_FALSE,
+    ]
     
-    # Search for specific terms
-    search_terms = extract_search_terms(query)
-    target_info = None
+    # Search for specific terms; only the two targeted lookups below use them
+    search_terms: Tuple[str, ...] = ()
 
     # Only attempt specific constraint lookup if query contains C<number>
-    has_specific_constraint = bool(re.search(r"\bC\d+\b", query, flags=re.IGNORECASE))
-
-    if has_specific_constraint and intent == "constraints":
-        for section in sections:
-            target_info = find_term_in_section(message_code, section, search_terms)
-            if target_info:
-                page_num, extracted, matched_term = target_info
-                response_parts.append(f"TARGET_PAGE:{page_num}")
-                response_parts.append(f"TARGET_TERM:{matched_term}")
-                break
+    if intent == "constraints" and _CNUM_RE.search(query) is not None:
+        search_terms = extract_search_terms(query)
 
     # CRITICAL FIX: For building blocks, use find_term_in_section to get exact match
-    if intent == "specific_building_block" and search_terms:
-        print(f"[DEBUG] Searching for building block with terms: {search_terms}")
-        for section in sections:
-            target_info = find_term_in_section(message_code, section, search_terms)
-            if target_info:
-                page_num, extracted, matched_term = target_info
-                response_parts.append(f"TARGET_PAGE:{page_num}")
-                response_parts.append(f"TARGET_TERM:{matched_term}")
-                print(f"[DEBUG] Found target on page {page_num}, term: {matched_term}")
-                break
+    elif intent == "specific_building_block":
+        search_terms = extract_search_terms(query)
+        logger.debug("Searching for building block with terms: %s", search_terms)
+
+    target_info = find_term_in_sections(message_code, sections, search_terms)
+    if target_info:
+        page_num, extracted, matched_term = target_info
+        response_parts += (f"TARGET_PAGE:{page_num}", f"TARGET_TERM:{matched_term}")
+        logger.debug("Found target on page %d, term: %s", page_num, matched_term)
     
     # Section page ranges
-    for section in sections:
-        bounds = _get_section_page_bounds(message_code, section)
-        if bounds:
-            start_page, end_page = bounds
-            response_parts.append(f"SECTION_PAGES:{section.upper()}:{start_page}-{end_page}")
+    response_parts += _section_page_lines(message_code, sections)
     
-    response_parts.append("---CONTENT_START---")
+    response_parts.append(_CONTENT_START)
     
     if wants_details:
         if target_info:
             _, extracted, _ = target_info
-            response_parts.append(f"##SECTION:EXTRACTED##")
-            response_parts.append(extracted)
+            response_parts += ("##SECTION:EXTRACTED##", extracted)
         else:
+            # Sections come from _SECTION_CACHE and are appended by reference;
+            # the final join below is the only copy made of their text
             for section in sections:
                 content = get_pages_content(message_code, section)
                 if content:
-                    response_parts.append(f"##SECTION:{section.upper()}##")
-                    response_parts.append(content)
+                    response_parts += (f"##SECTION:{section.upper()}##", content)
     
-    response_parts.append("---CONTENT_END---")
+    response_parts.append(_CONTENT_END)
     
     return "\n".join(response_parts)
+def answer_queries(queries: List[str]) -> List[str]:
+    """
+    answer_query for a batch, in input order. Each distinct query is answered
+    once; exact text is the key, as term extraction is case-sensitive.
+    """
+    answers = {query: answer_query(query) for query in dict.fromkeys(queries)}
+    return [answers[query] for query in queries]
+def preload_all(data_dir: Optional[str] = None) -> None:
+    """Parse every message PDF and slice all known sections into memory up front."""
+    data_dir = data_dir or _DEFAULT_DATA_DIR
+
+    # One PDF at a time: pypdf text extraction is pure Python and holds the
+    # GIL, so parsing the files on threads would not overlap
+    for name in sorted(set(MESSAGE_FILE_MAP.values())):
+        path = os.path.join(data_dir, name)
+        if os.path.exists(path):
+            _load_pdf_pages(path)
+
+    for message_code in SECTION_START_PAGES:
+        for section in SECTION_ORDER:
+            get_pages_content(message_code, section, data_dir)
+    print(f"[RAG] Preloaded {len(_PDF_CACHE)} PDFs, {len(_SECTION_CACHE)} sections")
+@lru_cache(maxsize=None)
+def _log_no_indexing() -> None:
+    print("[RAG] Using direct PDF reading via TOC. No indexing needed.")
+
 def index_documents(data_dir: Optional[str] = None) -> None:
-    print("[RAG] Using direct PDF reading via TOC. No indexing needed.")
\ No newline at end of file
+    """No-op kept for callers: PDFs are read directly via the TOC. Logs only on the first call."""
+    _log_no_indexing()
\ No newline at end of file